@@ -0,0 +1,402 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import string
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter
+import numpy as np
+import pandas as pd
+from preprocessor import Preprocessor, TEXT_COLUMNS
+from spimi import SPIMI
+from index_inverted import IndexInverted
+from paths import DATA_DIR, BLOCKS_DIR, THIS_DIR
+import postings
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+GENRES = ["pop", "rock", "rap", "r&b", "latin", "edm"]
+TRACK_ID_CHARACTERS = string.ascii_letters + string.digits
+
+def benchmark_tokenizer(file_name_data, tokenizer, stem_cache_size=65536, stop_words=True):
+    """
+    file_name_data: the name of the file containing the data (csv)
+    tokenizer: the tokenizer of the Preprocessor, "nltk" or "regex"
+    stem_cache_size: the size of the stem cache, 0 to disable it
+    """
+    """Measures the token throughput of a Preprocessor configuration, returns the results and its token stream."""
+    preprocessor = Preprocessor(file_name_data, stop_words=stop_words, tokenizer=tokenizer, stem_cache_size=stem_cache_size)
+
+    start_time = time.perf_counter()
+    tokens = list(preprocessor.token_stream())
+    execution_time = time.perf_counter() - start_time
+
+    result = {
+        "tokenizer": tokenizer,
+        "stem_cache_size": stem_cache_size,
+        "tokens": len(tokens),
+        "seconds": round(execution_time, 4),
+        "tokens_per_second": round(len(tokens) / execution_time) if execution_time else None,
+    }
+
+    if stem_cache_size: # Effectiveness of the stem cache
+        cache_info = preprocessor.stem.cache_info()
+        result["stem_cache"] = {"hits": cache_info.hits, "misses": cache_info.misses, "size": cache_info.currsize}
+
+    return result, tokens
+
+def compare_tokenizers(file_name_data, stop_words=True):
+    """Compares the throughput and the vocabulary of the regex fast path against the NLTK path."""
+    results = []
+    token_streams = {}
+
+    for tokenizer, stem_cache_size in (("nltk", 0), ("nltk", 65536), ("regex", 65536)):
+        result, tokens = benchmark_tokenizer(file_name_data, tokenizer, stem_cache_size=stem_cache_size, stop_words=stop_words)
+        results.append(result)
+        token_streams[tokenizer] = tokens
+
+    # Vocabulary equivalence of the two tokenizers (the stem cache does not change the output)
+    vocabulary_nltk = Counter(token for track_id, token in token_streams["nltk"])
+    vocabulary_regex = Counter(token for track_id, token in token_streams["regex"])
+
+    documents_nltk, documents_regex = {}, {}
+    for track_id, token in token_streams["nltk"]:
+        documents_nltk.setdefault(track_id, []).append(token)
+    for track_id, token in token_streams["regex"]:
+        documents_regex.setdefault(track_id, []).append(token)
+
+    common = vocabulary_nltk.keys() & vocabulary_regex.keys()
+    union = vocabulary_nltk.keys() | vocabulary_regex.keys()
+    track_ids = documents_nltk.keys() | documents_regex.keys()
+
+    equivalence = {
+        "terms_nltk": len(vocabulary_nltk),
+        "terms_regex": len(vocabulary_regex),
+        "terms_common": len(common),
+        "jaccard": round(len(common) / len(union), 4) if union else 1.0,
+        "only_nltk": sorted(vocabulary_nltk.keys() - vocabulary_regex.keys()),
+        "only_regex": sorted(vocabulary_regex.keys() - vocabulary_nltk.keys()),
+        "term_frequency_differences": sum(((vocabulary_nltk - vocabulary_regex) + (vocabulary_regex - vocabulary_nltk)).values()),
+        "identical_documents": sum(documents_nltk.get(track_id) == documents_regex.get(track_id) for track_id in track_ids),
+        "documents": len(track_ids),
+    }
+
+    return {"file_name_data": file_name_data, "results": results, "equivalence": equivalence}
+
+def zipf_vocabulary(vocabulary_size, zipf_exponent, rng):
+    """Returns a vocabulary of distinct synthetic words and the Zipfian probability of each one (the first is the most frequent)."""
+    words = {} # Distinct words in the order they were drawn, a set would iterate in the order of the string hashes (different in every process)
+    while len(words) < vocabulary_size:
+        length = rng.integers(3, 11)
+        words["".join(rng.choice(list(string.ascii_lowercase), size=length))] = None
+
+    ranks = np.arange(1, vocabulary_size + 1)
+    probabilities = 1.0 / ranks ** zipf_exponent
+
+    return rng.permutation(np.array(list(words))), probabilities / probabilities.sum()
+
+def generate_corpus(file_name_data, documents=1000, vocabulary_size=5000, zipf_exponent=1.1, words_per_document=200, seed=0):
+    """
+    file_name_data: the name of the csv written in the data directory
+    documents: the number of songs
+    vocabulary_size: the number of distinct words
+    zipf_exponent: the exponent of the Zipf distribution of the words
+    words_per_document: the average number of words of the lyrics of a song
+    """
+    """Writes a reproducible synthetic corpus with the columns of the songs, returns its vocabulary and the probabilities of its words."""
+    rng = np.random.default_rng(seed)
+    words, probabilities = zipf_vocabulary(vocabulary_size, zipf_exponent, rng)
+
+    def text(number_of_words):
+        return " ".join(rng.choice(words, size=max(number_of_words, 1), p=probabilities))
+
+    track_ids = set()
+    while len(track_ids) < documents:
+        track_ids.add("".join(rng.choice(list(TRACK_ID_CHARACTERS), size=22)))
+
+    rows = []
+    for track_id in sorted(track_ids): # The songs are sorted by track_id, as the real data
+        rows.append({
+            "track_id": track_id,
+            "track_name": text(rng.integers(1, 5)),
+            "track_artist": text(rng.integers(1, 3)),
+            "lyrics": text(rng.poisson(words_per_document)),
+            "track_album_name": text(rng.integers(1, 4)),
+            "playlist_name": text(rng.integers(1, 4)),
+            "playlist_genre": rng.choice(GENRES),
+        })
+
+    pd.DataFrame(rows, columns=["track_id"] + TEXT_COLUMNS).to_csv(DATA_DIR + file_name_data, index=False)
+
+    return words, probabilities
+
+def generate_queries(words, probabilities, number_of_queries, seed=0):
+    """Returns queries of 1 to 5 words drawn from the Zipf distribution of the corpus, popular words are queried the most."""
+    rng = np.random.default_rng(seed + 1)
+    return [" ".join(rng.choice(words, size=rng.integers(1, 6), p=probabilities)) for _ in range(number_of_queries)]
+
+def measure(function, trace_memory=True):
+    """Runs a function, returns its result, its seconds and the peak of the memory it allocated (tracemalloc, None if not traced)."""
+    if trace_memory:
+        tracemalloc.start()
+
+    start_time = time.perf_counter()
+    result = function()
+    execution_time = time.perf_counter() - start_time
+
+    peak_bytes = None
+    if trace_memory:
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result, {"seconds": round(execution_time, 4), "peak_bytes": peak_bytes}
+
+def latency_distribution(latencies):
+    """Returns the mean and the percentiles of latencies given in seconds, in milliseconds."""
+    latencies = np.array(latencies) * 1000
+    p50, p90, p95, p99 = np.percentile(latencies, [50, 90, 95, 99])
+
+    return {"mean": round(float(latencies.mean()), 4), "p50": round(p50, 4), "p90": round(p90, 4), "p95": round(p95, 4), "p99": round(p99, 4), "max": round(float(latencies.max()), 4)}
+
+def benchmark_build(file_name_data, directory, block_limit=200000, memory_limit=None, tokenizer="regex", trace_memory=True):
+    """
+    directory: the directory where the index is built
+    trace_memory: whether to record the peak memory of each phase (tracemalloc slows the phases down)
+    """
+    """Measures the token stream, the inversion of the blocks and their merge (which computes the idf, the norms and the max scores)."""
+    tokens, token_stream = measure(lambda: sum(1 for _ in Preprocessor(file_name_data, tokenizer=tokenizer).token_stream()), trace_memory)
+    token_stream["tokens"] = tokens
+    token_stream["tokens_per_second"] = round(tokens / token_stream["seconds"]) if token_stream["seconds"] else None
+
+    spimi = SPIMI(file_name_data, block_limit=block_limit, memory_limit=memory_limit, tokenizer=tokenizer, directory=directory)
+    if not os.path.exists(spimi.staging_directory):
+        os.makedirs(spimi.staging_directory)
+
+    blocks, inversion = measure(spimi.spimi, trace_memory)
+    inversion["blocks"] = len(blocks)
+    inversion["postings"] = sum(block["postings"] for block in spimi.block_stats)
+    inversion["postings_per_second"] = round(inversion["postings"] / inversion["seconds"]) if inversion["seconds"] else None
+    inversion["documents"] = len(spimi.documents)
+
+    postings.write_documents(spimi.staging_directory + postings.DOCUMENTS_FILE, spimi.documents)
+    merge_passes, merge = measure(lambda: spimi.merge(blocks), trace_memory)
+    merge["passes"] = merge_passes
+    merge["bytes_on_disk"] = {file_name: os.path.getsize(spimi.staging_directory + file_name) for file_name in (postings.LEXICON_FILE, postings.POSTINGS_FILE, postings.OFFSETS_FILE, postings.DOCUMENTS_FILE, postings.NORMS_FILE, postings.MAX_SCORES_FILE)}
+    spimi.publish() # For the queries
+
+    return {"token_stream": token_stream, "spimi": inversion, "merge": merge}
+
+def benchmark_queries(file_name_data, directory, queries, topk=10, tokenizer="regex"):
+    """Measures the latency of cosine_similarity with and without pruning, with the caches disabled so that every query is scored."""
+    index_inverted = IndexInverted(file_name_data, None, tokenizer=tokenizer, directory=directory, postings_cache_size=0, result_cache_size=0)
+    _, open_reader = measure(index_inverted.reader, trace_memory=False)
+    results = {"open_reader_seconds": open_reader["seconds"]}
+
+    for pruning in (False, True):
+        latencies = []
+        postings_evaluated = 0
+
+        for query in queries:
+            start_time = time.perf_counter()
+            index_inverted.cosine_similarity(query, topk, pruning=pruning)
+            latencies.append(time.perf_counter() - start_time)
+            postings_evaluated += index_inverted.postings_evaluated
+
+        results["maxscore" if pruning else "exhaustive"] = {
+            "queries": len(queries),
+            "latency_ms": latency_distribution(latencies),
+            "queries_per_second": round(len(queries) / sum(latencies), 1),
+            "postings_evaluated": postings_evaluated,
+        }
+
+    index_inverted.close()
+    return results
+
+def verify_pruning(documents=3000, queries=3000, topks=(1, 3, 10, 50), tokenizer="regex", seed=0):
+    """
+    queries: the number of queries, half drawn from the Zipf distribution of the corpus and half uniformly from its vocabulary (rare terms)
+    topks: the k of the top k compared for every query
+    """
+    """Checks that cosine_similarity returns the same top k with and without pruning on a synthetic corpus, returns the number of checks and of mismatches."""
+    file_name_data = "verify_corpus.csv"
+    directory = BLOCKS_DIR + "verify_pruning/"
+
+    try:
+        words, probabilities = generate_corpus(file_name_data, documents, seed=seed)
+        index_inverted = IndexInverted(file_name_data, None, tokenizer=tokenizer, directory=directory, postings_cache_size=0, result_cache_size=0)
+        index_inverted.create_index_inverted()
+
+        rng = np.random.default_rng(seed + 2)
+        uniform_queries = [" ".join(rng.choice(words, size=rng.integers(1, 9))) for _ in range(queries - queries // 2)]
+
+        checks = mismatches = 0
+        for query in generate_queries(words, probabilities, queries // 2, seed) + uniform_queries:
+            for topk in topks:
+                checks += 1
+                if index_inverted.cosine_similarity(query, topk, pruning=False) != index_inverted.cosine_similarity(query, topk, pruning=True):
+                    mismatches += 1
+
+        index_inverted.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        if os.path.exists(DATA_DIR + file_name_data):
+            os.remove(DATA_DIR + file_name_data)
+
+    return {"checks": checks, "mismatches": mismatches}
+
+def same_results(index_inverted, expected_index_inverted, queries, topk):
+    """Returns the number of queries (with and without pruning) whose top k scores differ between two indexes."""
+    mismatches = 0
+    for query in queries:
+        for pruning in (False, True):
+            scores = sorted((score for _, score in index_inverted.cosine_similarity(query, topk, pruning=pruning)), reverse=True)
+            expected_scores = sorted((score for _, score in expected_index_inverted.cosine_similarity(query, topk, pruning=pruning)), reverse=True)
+            if len(scores) != len(expected_scores) or not np.allclose(scores, expected_scores): # Tied documents may come in another order
+                mismatches += 1
+    return mismatches
+
+def verify_segments(documents=1000, queries=200, topk=10, tokenizer="regex", seed=0):
+    """
+    documents: the number of songs, added to the segmented index in three overlapping parts
+    queries: the number of queries compared after each step
+    """
+    """Checks that a segmented index returns the same scores as a full rebuild after additions, updates, merges, deletions and compaction, returns the mismatches of each step."""
+    file_names = ["verify_corpus.csv", "verify_part1.csv", "verify_part2.csv", "verify_part3.csv", "verify_expected.csv"]
+    directories = [BLOCKS_DIR + "verify_segments/", BLOCKS_DIR + "verify_expected/"]
+    results = {}
+
+    def expected_index(data):
+        """Rebuilds the index of the expected documents from scratch."""
+        data.to_csv(DATA_DIR + file_names[4], index=False)
+        index_inverted = IndexInverted(file_names[4], None, tokenizer=tokenizer, directory=directories[1], postings_cache_size=0, result_cache_size=0)
+        index_inverted.create_index_inverted()
+        return index_inverted
+
+    try:
+        words, probabilities = generate_corpus(file_names[0], documents, seed=seed)
+        query_list = generate_queries(words, probabilities, queries, seed)
+        data = pd.read_csv(DATA_DIR + file_names[0])
+
+        # The third part updates the documents it shares with the second one, with the lyrics of other songs
+        half, three_quarters, overlap = documents // 2, documents * 3 // 4, documents // 20
+        updates = data.iloc[three_quarters - overlap:].copy()
+        updates.iloc[:overlap, updates.columns.get_loc("lyrics")] = data["lyrics"].iloc[:overlap].values
+        parts = [data.iloc[:half], data.iloc[half:three_quarters], updates]
+        for file_name, part in zip(file_names[1:4], parts):
+            part.to_csv(DATA_DIR + file_name, index=False)
+        data = pd.concat(parts).drop_duplicates("track_id", keep="last")
+
+        segmented = IndexInverted(file_names[1], None, tokenizer=tokenizer, segmented=True, merge_factor=2, directory=directories[0], postings_cache_size=0, result_cache_size=0)
+        segmented.create_index_inverted()
+        for file_name in file_names[2:4]:
+            segmented.add_documents(file_name)
+        expected = expected_index(data)
+        results["updates"] = same_results(segmented, expected, query_list, topk) # Possibly while the segments are merged in the background
+
+        segmented.segments.wait()
+        results["merged"] = same_results(segmented, expected, query_list, topk)
+
+        deleted = data["track_id"].sample(frac=0.1, random_state=seed)
+        segmented.delete_documents(deleted)
+        segmented.segments.wait()
+        expected.close()
+        expected = expected_index(data[~data["track_id"].isin(deleted)])
+        results["deletes"] = same_results(segmented, expected, query_list, topk)
+
+        segmented.segments.compact()
+        results["compacted"] = same_results(segmented, expected, query_list, topk)
+
+        segmented.close()
+        expected.close()
+    finally:
+        for directory in directories:
+            shutil.rmtree(directory, ignore_errors=True)
+        for file_name in file_names:
+            if os.path.exists(DATA_DIR + file_name):
+                os.remove(DATA_DIR + file_name)
+
+    return {"queries": queries, "mismatches": results}
+
+def commit():
+    """Returns the commit of the working tree the benchmark runs on, None outside of git."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=THIS_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def peak_rss_bytes():
+    """Returns the peak resident memory of the process, None where it is not available."""
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 # Bytes on macOS, kilobytes on Linux
+
+def run_benchmark(documents=1000, vocabulary_size=5000, zipf_exponent=1.1, words_per_document=200, queries=200, topk=10, block_limit=200000, memory_limit=None, tokenizer="regex", seed=0, trace_memory=True, keep=False):
+    """
+    queries: the number of queries whose latency is measured
+    keep: whether to keep the synthetic corpus and its index, deleted after the run otherwise
+    """
+    """Generates a synthetic corpus, builds its index, queries it and returns the results to compare across commits."""
+    file_name_data = "benchmark_corpus.csv"
+    directory = BLOCKS_DIR + "benchmark/"
+    parameters = {"documents": documents, "vocabulary_size": vocabulary_size, "zipf_exponent": zipf_exponent, "words_per_document": words_per_document, "queries": queries, "topk": topk, "block_limit": block_limit, "memory_limit": memory_limit, "tokenizer": tokenizer, "seed": seed, "trace_memory": trace_memory}
+
+    try:
+        (words, probabilities), corpus = measure(lambda: generate_corpus(file_name_data, documents, vocabulary_size, zipf_exponent, words_per_document, seed), trace_memory=False)
+        build = benchmark_build(file_name_data, directory, block_limit=block_limit, memory_limit=memory_limit, tokenizer=tokenizer, trace_memory=trace_memory)
+        search = benchmark_queries(file_name_data, directory, generate_queries(words, probabilities, queries, seed), topk=topk, tokenizer=tokenizer)
+    finally:
+        if not keep:
+            shutil.rmtree(directory, ignore_errors=True)
+            if os.path.exists(DATA_DIR + file_name_data):
+                os.remove(DATA_DIR + file_name_data)
+
+    return {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "parameters": parameters,
+        "corpus_seconds": corpus["seconds"],
+        "build": build,
+        "queries": search,
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the index build and the queries on a synthetic corpus.")
+    parser.add_argument("--documents", type=int, default=1000)
+    parser.add_argument("--vocabulary", type=int, default=5000)
+    parser.add_argument("--zipf", type=float, default=1.1)
+    parser.add_argument("--words", type=int, default=200, help="average number of words of the lyrics")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--topk", type=int, default=10)
+    parser.add_argument("--block-limit", type=int, default=200000)
+    parser.add_argument("--memory-limit", default=None)
+    parser.add_argument("--tokenizer", default="regex", choices=["nltk", "regex"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-trace-memory", action="store_true", help="do not trace the peak memory of each phase (faster)")
+    parser.add_argument("--output", help="JSON file of the results, printed if not given")
+    parser.add_argument("--compare-tokenizers", metavar="CSV", help="compare the tokenizers on a csv of the data directory instead")
+    parser.add_argument("--verify", action="store_true", help="check that pruning and the segments return the same results as exhaustive scoring and a full rebuild instead")
+    arguments = parser.parse_args()
+
+    if arguments.compare_tokenizers:
+        results = compare_tokenizers(arguments.compare_tokenizers)
+    elif arguments.verify:
+        results = {"pruning": verify_pruning(tokenizer=arguments.tokenizer, seed=arguments.seed), "segments": verify_segments(tokenizer=arguments.tokenizer, seed=arguments.seed)}
+    else:
+        results = run_benchmark(arguments.documents, arguments.vocabulary, arguments.zipf, arguments.words, arguments.queries, arguments.topk, arguments.block_limit, arguments.memory_limit, arguments.tokenizer, arguments.seed, not arguments.no_trace_memory)
+
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            json.dump(results, file, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
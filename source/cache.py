@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    def __init__(self, capacity, size=None):
+        """
+        capacity: the maximum total size of the values, 0 disables the cache
+        size: a function returning the size of a value (e.g. its bytes), 1 per value if None
+        """
+        self.capacity = capacity
+        self.size = size or (lambda value: 1)
+        self.entries = OrderedDict() # key -> (value, size), the least recently used first
+        self.total_size = 0
+        self.lock = threading.Lock() # The cache is shared by the threads of a batch
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Returns the value of a key and marks it as the most recently used, None if it is not cached."""
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Caches a value, evicting the least recently used ones until it fits."""
+        value_size = self.size(value)
+
+        if value_size > self.capacity: # It would evict everything else and still not fit
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.total_size -= self.entries.pop(key)[1]
+
+            while self.entries and self.total_size + value_size > self.capacity:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_size -= evicted_size
+                self.evictions += 1
+
+            self.entries[key] = (value, value_size)
+            self.total_size += value_size
+
+    def clear(self):
+        """Drops every value, when the data they were computed from changes."""
+        with self.lock:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.total_size = 0
+
+    def stats(self):
+        """Returns the counters of the cache."""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "invalidations": self.invalidations, "entries": len(self.entries), "size": self.total_size, "capacity": self.capacity}
@@ -1,11 +1,15 @@
 import time
+from functools import wraps
+from instrumentation import default_instrumentation
 
 def timing(func):
+    """Prints the wall time of every call, which is also recorded as a phase of the default instrumentation (see instrumentation.py)."""
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        execution_time = end_time - start_time
+        start_time = time.perf_counter_ns()
+        with default_instrumentation().phase(func.__qualname__):
+            result = func(*args, **kwargs)
+        execution_time = (time.perf_counter_ns() - start_time) / 1e9
         print(f"Execution time: {execution_time} seconds")
         return result
     return wrapper
@@ -1,149 +1,587 @@
 import json
 import pandas as pd
-import ast
 import sys
 import os
-import struct
+import time
+import threading
 import numpy as np
 from collections import Counter
-from spimi import SPIMI
+from concurrent.futures import ThreadPoolExecutor
+from spimi import SPIMI, parse_size
+from cache import LRUCache
+from segments import SegmentedIndex
 from preprocessor import Preprocessor
 from paths import DATA_DIR, BLOCKS_DIR
+from query import parse_query, intersect
+import postings
+from instrumentation import default_instrumentation, instrumented
+
+# BM25F scoring of the boolean queries
+BM25_K1 = 1.2 # Saturation of the combined tf of a term
+BM25_B = 0.75 # Normalization of the tf of a field by its length relative to the average one
+FIELD_WEIGHTS = {"name": 3.0, "artist": 2.0, "lyrics": 1.0, "album": 1.5, "playlist": 0.5, "genre": 0.5} # A match in the name of a song counts as 3 in its lyrics
 
 class IndexInverted:
-    def __init__(self, file_name_data, number_of_dcouments, block_limit=200000, stop_words=True):
+    def __init__(self, file_name_data, number_of_dcouments, block_limit=200000, stop_words=True, fan_in=16, workers=1, memory_limit=None, tokenizer="nltk", chunk_size=1000, segmented=False, merge_factor=4, postings_cache_size="64MB", result_cache_size=1024, directory=BLOCKS_DIR, instrumentation=None, positional=False, staging_directory=None, fields=False, field_weights=None):
         """
         file_name_data: the name of the file containing the data (csv)
         number_of_dcouments: the number of documents in the data
+        fan_in: the maximum number of blocks merged at the same time
+        workers: the number of processes building blocks in parallel (1 for a serial build)
+        memory_limit: if given (bytes or a string like "512MB"), the estimated memory budget of a block, replacing block_limit
+        tokenizer: the tokenizer used for the documents and the queries, "nltk" or "regex"
+        chunk_size: the number of rows of the csv read at a time
+        segmented: whether the index is made of segments updated incrementally (add_documents, delete_documents), the idf then counts the live documents
+        merge_factor: the number of segments of the same size merged together in the background
+        postings_cache_size: the memory budget (bytes or a string like "64MB") of the decoded postings lists cached by term, 0 to disable it
+        result_cache_size: the number of query results cached, 0 to disable it
+        directory: the directory of the index files (of its segments in the incremental mode)
+        instrumentation: the Instrumentation recording the phases and counters of the builds and the queries, the default one if None
+        positional: whether to index the positions of the tokens, for phrase_search
+        staging_directory: the directory in which the global index is built (in its staging/ subdirectory) before it replaces the published one, directory if None
+        fields: whether to index the fields of the songs apart too, for boolean_search
+        field_weights: the weight of a match in each field in boolean_search, replacing the ones of FIELD_WEIGHTS
         """
+        if segmented and positional:
+            raise ValueError("positional indexes cannot be segmented, the merge of the segments does not keep the positions")
+        if segmented and fields:
+            raise ValueError("indexes with fields cannot be segmented, the merge of the segments does not keep the field lengths")
+
         self.file_name_data = file_name_data
         self.number_of_dcouments = number_of_dcouments
         self.block_limit = block_limit
         self.stop_words = stop_words
-
+        self.fan_in = fan_in
+        self.workers = workers
+        self.memory_limit = memory_limit
+        self.tokenizer = tokenizer
+        self.chunk_size = chunk_size
+        self.positional = positional
+        self.staging_directory = staging_directory
+        self.fields = fields
+        self.field_weights = dict(FIELD_WEIGHTS, **(field_weights or {}))
+        self.directory = os.path.join(directory, "")
+        self.instrumentation = instrumentation if instrumentation is not None else default_instrumentation()
+
+        self.segments = None # Segments of the index in the incremental mode
+        if segmented:
+            self.segments = SegmentedIndex(self.directory + "segments/", options={"block_limit": block_limit, "stop_words": stop_words, "fan_in": fan_in, "workers": workers, "memory_limit": memory_limit, "tokenizer": tokenizer, "chunk_size": chunk_size, "instrumentation": self.instrumentation}, merge_factor=merge_factor)
+
+        self.index_reader = None # Long-lived reader of the global index, opened on the first query
+        self.index_reader_version = None # Version of the index files the reader was opened on
+        self.reader_lock = threading.Lock() # Queries may run in several threads
+        # The query tokens are counted apart from the tokens of the build
+        self.query_preprocessor = Preprocessor(None, stop_words=self.stop_words, tokenizer=self.tokenizer, instrumentation=self.instrumentation, tokens_counter="query_tokens")
+        self.phrase_preprocessor = Preprocessor(None, stop_words=self.stop_words, tokenizer=self.tokenizer, instrumentation=self.instrumentation, positions=True, tokens_counter="query_tokens")
+
+        # Both caches are dropped when the index files change
+        self.postings_cache = LRUCache(parse_size(postings_cache_size), size=lambda postings_arrays: postings_arrays[0].nbytes + postings_arrays[1].nbytes) # term -> (docIDs, tfs)
+        self.result_cache = LRUCache(result_cache_size) # (query terms and their tf, topk, pruning) -> top k
+        self.postings_evaluated = 0 # Number of postings scored by the last query, not the ones only decoded
+        self.batch_stats = None # Throughput of the last batch_search
+
+    def index_version(self):
+        """Returns what identifies the current index files: the generation of the segments, or the inode and modification time of the current generation pointer of the global index."""
+        if self.segments is not None:
+            return self.segments.generation
+
+        # A single stat per query: every build and conversion publishes a new generation by replacing the pointer, the files of a generation never change
+        try:
+            stat = os.stat(os.path.join(self.directory, postings.CURRENT_FILE))
+        except FileNotFoundError: # An index written in place before generations, replaced only by publishing one
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def reader(self):
+        """Returns the reader of the global index, opening it once (again when the index files change)."""
+        version = self.index_version()
+
+        with self.reader_lock:
+            if self.index_reader is not None and self.index_reader_version == version:
+                return self.index_reader
+
+        # Opened outside the lock, the other queries keep the current reader meanwhile
+        with self.instrumentation.phase("index.open_reader"):
+            index_reader = self.segments.reader() if self.segments is not None else postings.IndexReader(self.directory)
+
+        with self.reader_lock:
+            if self.index_reader is not None and self.index_reader_version == version: # Opened by another query meanwhile
+                index_reader.close()
+                return self.index_reader
+
+            # Stale: the index was rebuilt, or documents were added, deleted or merged since it was opened
+            # Not closed, the queries still running on it unmap its files once done
+            self.postings_cache.clear()
+            self.result_cache.clear()
+            self.index_reader = index_reader
+            self.index_reader_version = version
+            return self.index_reader
+
+    def close(self):
+        """Releases the reader of the global index and drops the caches computed from it."""
+        if self.index_reader is not None:
+            self.index_reader.close()
+            self.index_reader = None
+
+        self.postings_cache.clear()
+        self.result_cache.clear()
+
+    def cache_stats(self):
+        """Returns the hit, miss and eviction counters of the postings and result caches."""
+        return {"postings": self.postings_cache.stats(), "results": self.result_cache.stats()}
+
+    @instrumented("index.create")
     def create_index_inverted(self):
-        """Creates the inverted index and writes it to disk."""
-        spimi = SPIMI(self.file_name_data, block_limit=self.block_limit, stop_words=self.stop_words).start() # Create the SPIMI object
+        """Creates the inverted index (with the idf of the terms and the norms of the documents) and writes it to disk."""
+        self.close() # The index files are about to be replaced
 
-        if spimi: # If SPIMI completed successfully
-            self.write_norm_to_disk()
+        if self.segments is not None: # Start over with a single segment
+            self.segments.clear()
+            self.segments.add_documents(self.file_name_data)
+            return
 
-    def write_norm_to_disk(self):
-        """Writes the norm of each document to disk."""
-        norms = {} # Dictionary of document id to norm of document
+        SPIMI(self.file_name_data, block_limit=self.block_limit, stop_words=self.stop_words, fan_in=self.fan_in, workers=self.workers, memory_limit=self.memory_limit, tokenizer=self.tokenizer, chunk_size=self.chunk_size, number_of_documents=self.number_of_dcouments, directory=self.directory, instrumentation=self.instrumentation, positional=self.positional, staging_directory=self.staging_directory, fields=self.fields).start() # Create the SPIMI object
 
-        with open(BLOCKS_DIR + "global_index.txt", "r") as file_global_index:
-            for line in file_global_index:
-                postings_list = ast.literal_eval(line)[1] # Get the postings list
+    def add_documents(self, file_name_data):
+        """Indexes the documents of a csv in a new segment, replacing the documents with the same track_id."""
+        if self.segments is None:
+            raise ValueError("the index is not segmented, create it with segmented=True to add documents")
+        return self.segments.add_documents(file_name_data)
 
-                idf = np.log10(self.number_of_dcouments / len(postings_list))
+    def delete_documents(self, track_ids):
+        """Deletes the documents with the given track_ids, returns the number of documents deleted."""
+        if self.segments is None:
+            raise ValueError("the index is not segmented, create it with segmented=True to delete documents")
+        return self.segments.delete_documents(track_ids)
 
-                for document_id, tf in postings_list:
-                    tf = np.log10(tf + 1)
-                    norms[document_id] = norms.get(document_id, 0) + (tf * idf) ** 2
+    def search_term(self, token):
+        """Returns the postings list (docID, tf) of a token, None if it is not in the index."""
+        return self.reader().postings_list(token)
 
-        with open(DATA_DIR + "norms.bin", "wb") as file_norms:
-            for document_id, norm in sorted(norms.items()):
-                norm = round(np.sqrt(norm), 6) # Round to 6 decimal places
+    def search_norm(self, document_id):
+        """Returns the norm of a document (docID)."""
+        self.instrumentation.count("norm_lookups")
+        return float(self.reader().norms[document_id])
+
+    def norms(self):
+        """Returns the norms of the documents as a NumPy array indexed by docID."""
+        return self.reader().norms
+
+    def preprocess_query(self, query):
+        """Returns the terms of a query, preprocessed as the documents."""
+        return [token for i, token in self.query_preprocessor._preprocess("query", query)]
+
+    def cache_get(self, cache, reader, key):
+        """Returns the entry of a cache computed with a reader, None if it is not cached or the reader is no longer the current one."""
+        with self.reader_lock: # The caches are dropped under the lock when the reader changes
+            return cache.get(key) if reader is self.index_reader else None
+
+    def cache_put(self, cache, reader, key, value):
+        """Caches an entry computed with a reader, unless the reader is no longer the current one (the caches hold the current index only)."""
+        with self.reader_lock:
+            if reader is self.index_reader:
+                cache.put(key, value)
+
+    def postings_arrays(self, token, reader=None):
+        """
+        reader: the reader of the query, the current one if not given
+        """
+        """Returns the postings list of a token as NumPy arrays (docIDs, tfs) through the postings cache, None if it is not in the index."""
+        reader = reader if reader is not None else self.reader()
+        postings_arrays = self.cache_get(self.postings_cache, reader, token)
 
-                id_encode = document_id.encode("utf-8") # Encode the document id
-                norm_encode = struct.pack("f", norm)
+        if postings_arrays is None:
+            postings_arrays = reader.postings_arrays(token)
+            if postings_arrays is not None:
+                for array in postings_arrays: # Shared by every query hitting the cache
+                    array.flags.writeable = False
+                self.cache_put(self.postings_cache, reader, token, postings_arrays)
 
-                file_norms.write(id_encode)
-                file_norms.write(norm_encode)
+        return postings_arrays
 
-    def search_term(self, token):
-        """Returns the postings list of a token using binary search."""
-        with open(BLOCKS_DIR + "global_index.txt", "r") as file_global_index, open(BLOCKS_DIR + "metadata.bin", "rb") as file_metadata:
-            low = 0
-            high = file_metadata.seek(0, os.SEEK_END) // struct.calcsize("i") - 1 # Get the number of tokens in the file
-
-            result = None
-
-            while low <= high:
-                mid = (low + high) // 2
-
-                # struct.calcsize("i") is the size of an integer in bytes
-                file_metadata.seek(mid * struct.calcsize("i")) # Seek to the middle of the file
-                physical_position = struct.unpack("i", file_metadata.read(struct.calcsize("i")))[0] # Get the physical position of the token in the file
-
-                file_global_index.seek(physical_position)
-                line = file_global_index.readline() # Get the line at the current position in the file
-                other_token = ast.literal_eval(line)[0] # Get the token at the current position
-
-                if token < other_token:
-                    high = mid - 1 # Search the left half
-                elif token > other_token:
-                    low = mid + 1 # Search the right half
-                else:
-                    postings_list = ast.literal_eval(line)[1] # Get the postings list
-                    result = postings_list
+    @instrumented("index.query")
+    def cosine_similarity(self, query, topk, pruning=False):
+        """
+        query: the text of the query
+        topk: the number of documents to return
+        pruning: whether to use dynamic pruning with the per-term max scores (same results, fewer postings scored)
+        """
+        """Returns the top k (track_id, score) pairs for a given query."""
+        reader = self.reader() # Drops the caches if the index changed
+        tfs_query = Counter(self.preprocess_query(query))
+        self.instrumentation.count("queries")
+
+        key = self.query_key(tfs_query, topk, pruning)
+        result = self.cache_get(self.result_cache, reader, key)
+        if result is not None:
+            self.postings_evaluated = 0
+            return list(result)
+
+        result = self.rank(reader, tfs_query, topk, pruning, {token: self.postings_arrays(token, reader) for token in tfs_query})
+        self.cache_put(self.result_cache, reader, key, tuple(result))
+
+        return result
+
+    @instrumented("index.phrase_query")
+    def phrase_search(self, query, topk, slop=0):
+        """
+        query: the text of the phrase
+        topk: the number of documents to return
+        slop: the maximum distance of every term from its place in the phrase relative to the first term, 0 for the exact phrase
+        """
+        """Returns the top k (track_id, score) pairs of the documents containing the phrase, scored by cosine similarity on its terms."""
+        reader = self.reader()
+        phrase = [(token, position) for i, token, position in self.phrase_preprocessor._preprocess("query", query)] # Stop words keep their place
+
+        if not phrase:
+            return []
+
+        postings_arrays = {token: self.postings_arrays(token, reader) for token, position in phrase}
+        if any(arrays is None for arrays in postings_arrays.values()): # A term of the phrase is not in the index
+            return []
+
+        # Documents containing every term, intersecting from the rarest term
+        document_ids = None
+        for token in sorted(postings_arrays, key=lambda token: len(postings_arrays[token][0])):
+            document_ids = postings_arrays[token][0] if document_ids is None else np.intersect1d(document_ids, postings_arrays[token][0], assume_unique=True)
+
+        # Positions of each term in those documents only, through the skip pointers of its positions
+        positions = []
+        for token, position in phrase:
+            term_document_ids, tfs = postings_arrays[token]
+            positions.append(reader.positions(token, tfs, np.searchsorted(term_document_ids, document_ids)))
+
+        matches = np.zeros(len(document_ids), dtype=bool)
+        for i in range(len(document_ids)):
+            starts = positions[0][i] - phrase[0][1] # Candidate positions of the start of the phrase
+
+            for term_positions, (token, position) in zip(positions[1:], phrase[1:]):
+                term_starts = term_positions[i] - position
+
+                if slop == 0:
+                    starts = starts[np.isin(starts, term_starts)]
+                else: # Distance to the nearest start given by the term
+                    nearest = np.searchsorted(term_starts, starts)
+                    distances = np.minimum(np.abs(starts - term_starts[np.maximum(nearest - 1, 0)]), np.abs(term_starts[np.minimum(nearest, len(term_starts) - 1)] - starts))
+                    starts = starts[distances <= slop]
+
+                if not len(starts):
                     break
 
-            return result # Return the postings list of the token if found, otherwise None
+            matches[i] = len(starts) > 0
 
-    def search_norm(self, document_id):
-        """Returns the norm of a document using binary search."""
-        with open(DATA_DIR + "norms.bin", "rb") as file_norms:
-            low = 0
-            high = file_norms.seek(0, os.SEEK_END) // (len(document_id) + struct.calcsize("f")) - 1 # Get the number of documents in the file (self.number_of_dcouments - 1)
-
-            result = None
-
-            while low <= high:
-                mid = (low + high) // 2
-
-                # len(document_id) is the size of the document id in bytes
-                # struct.calcsize("f") is the size of a float in bytes
-                file_norms.seek(mid * (len(document_id) + struct.calcsize("f"))) # Seek to the middle of the file
-                other_document_id = file_norms.read(len(document_id)).decode("utf-8") # Get the document id at the current position in the file
-
-                if document_id < other_document_id:
-                    high = mid - 1
-                elif document_id > other_document_id:
-                    low = mid + 1
-                else:
-                    norm = struct.unpack("f", file_norms.read(struct.calcsize("f")))[0] # Get the norm of the document
-                    result = norm
+        document_ids = document_ids[matches]
+
+        # Rank the matching documents as cosine_similarity would rank them for the terms of the phrase
+        matching_postings_arrays = {}
+        for token, (term_document_ids, tfs) in postings_arrays.items():
+            mask = np.isin(term_document_ids, document_ids, assume_unique=True)
+            matching_postings_arrays[token] = (term_document_ids[mask], tfs[mask])
+
+        return self.rank(reader, Counter(token for token, position in phrase), topk, False, matching_postings_arrays)
+
+    @instrumented("index.boolean_query")
+    def boolean_search(self, query, topk):
+        """
+        query: terms and field:term operands (e.g. genre:pop) combined with AND, OR, NOT and parentheses, adjacent operands are joined by AND
+        topk: the number of documents to return
+        """
+        """Returns the top k (track_id, score) pairs of the documents matching a boolean query, scored by BM25F for its terms not under a NOT."""
+        reader = self.reader()
+
+        if reader.field_lengths is None:
+            raise ValueError(f"{reader.directory}: the index has no {postings.FIELD_LENGTHS_FILE}, rebuild it with fields=True to use boolean queries")
+
+        key = ("boolean", query, topk)
+        results = self.cache_get(self.result_cache, reader, key)
+        if results is not None:
+            return list(results)
+
+        terms = [] # (field or None, token) of the terms the documents are scored for
+        document_ids = self.boolean_documents(reader, parse_query(query, reader.field_names), terms)
+
+        if document_ids is None: # Only stop words
+            results = []
+        else:
+            results = self.bm25f(reader, document_ids, terms, topk)
+
+        self.cache_put(self.result_cache, reader, key, tuple(results))
+        return results
+
+    def query_terms(self, node):
+        """Returns the terms of the index of a term of a boolean query: its tokens, qualified by its field if it has one."""
+        field, text = node[1], node[2]
+        return [field + postings.FIELD_SEPARATOR + token if field else token for token in self.preprocess_query(text)]
+
+    def estimate_documents(self, reader, node):
+        """Returns an upper bound of the number of documents matching a node of a boolean query, from the document frequencies alone."""
+        if node[0] == "term":
+            return min((reader.document_frequency(term) for term in self.query_terms(node)), default=len(reader.documents))
+        if node[0] == "and":
+            return min((self.estimate_documents(reader, child) for child in node[1] if child[0] != "not"), default=len(reader.documents))
+        if node[0] == "or":
+            return sum(self.estimate_documents(reader, child) for child in node[1])
+
+        return len(reader.documents)
+
+    def boolean_documents(self, reader, node, terms):
+        """
+        node: a node of the tree of a boolean query (see query.QueryParser)
+        terms: the list the (field, token) of the terms scored are appended to, None under a NOT
+        """
+        """Returns the sorted docIDs matching a node, None if it does not restrict them (its terms are all stop words)."""
+        kind = node[0]
+
+        if kind == "term":
+            query_terms = self.query_terms(node)
+            if terms is not None:
+                terms.extend((node[1], token) for token in self.preprocess_query(node[2]))
+
+            document_ids = None
+            for term in sorted(query_terms, key=reader.document_frequency): # The rarest first, the other postings lists are not read once nothing is left
+                if document_ids is not None and not len(document_ids):
                     break
+                postings_arrays = self.postings_arrays(term, reader)
+                term_document_ids = postings_arrays[0] if postings_arrays is not None else np.array([], dtype=np.int64)
+                document_ids = term_document_ids if document_ids is None else intersect(document_ids, term_document_ids)
+            return document_ids
+
+        if kind == "not": # Alone, every other document
+            excluded = self.boolean_documents(reader, node[1], None)
+            return np.setdiff1d(np.arange(len(reader.documents)), excluded, assume_unique=True) if excluded is not None else None
+
+        if kind == "or":
+            document_ids = None
+            for child in node[1]:
+                child_document_ids = self.boolean_documents(reader, child, terms)
+                if child_document_ids is not None:
+                    document_ids = child_document_ids if document_ids is None else np.union1d(document_ids, child_document_ids)
+            return document_ids
+
+        # and: intersect the operands from the smallest estimate, then remove the documents of the negated ones
+        document_ids = None
+        for child in sorted((child for child in node[1] if child[0] != "not"), key=lambda child: self.estimate_documents(reader, child)):
+            if document_ids is not None and not len(document_ids): # Nothing left, the other postings lists are not read
+                return document_ids
+            child_document_ids = self.boolean_documents(reader, child, terms)
+            if child_document_ids is not None:
+                document_ids = child_document_ids if document_ids is None else intersect(document_ids, child_document_ids)
+
+        for child in node[1]:
+            if child[0] == "not" and (document_ids is None or len(document_ids)):
+                excluded = self.boolean_documents(reader, child[1], None)
+                if excluded is not None:
+                    document_ids = np.setdiff1d(document_ids if document_ids is not None else np.arange(len(reader.documents)), excluded, assume_unique=True)
+
+        return document_ids
+
+    def bm25f(self, reader, document_ids, terms, topk):
+        """
+        document_ids: the sorted docIDs of the documents to score
+        terms: the (field or None, token) of the terms scored, a term without field matches in all of them
+        """
+        """Scores documents with BM25F: the tf of a term in each field normalized by the length of the field and weighted by field_weights, saturated by BM25_K1. Returns the top k (track_id, score) pairs."""
+        scores = np.zeros(len(document_ids))
+        number_of_documents = len(reader.documents)
 
-            return result # Return the norm of the document if found, otherwise None
-        
-    def cosine_similarity(self, query, topk):
-        """Returns the top k documents for a given query."""
-        scores = {} # Dictionary of document id to score
+        for field, token in dict.fromkeys(terms): # Each term once, in order
+            tfs = np.zeros(len(document_ids)) # Combined tf of the term in the documents
 
-        query_preprocessed = [token for i, token in Preprocessor(None)._preprocess("query", query)] # Preprocess the query
-        norm_query = 0
-        for token, tf_query in Counter(query_preprocessed).items():
-            postings_list = self.search_term(token)
+            for field_number, field_name in enumerate(reader.field_names):
+                if field is not None and field_name != field:
+                    continue
 
-            if postings_list: # If the token is in the index
-                idf = np.log10(self.number_of_dcouments / len(postings_list)) # Calculate the idf of the token (universal for all documents)
-                tf_query = np.log10(tf_query + 1) # Calculate the tf of the token in the query
-                wt_query = tf_query * idf # Calculate the weight of the token in the query
+                postings_arrays = self.postings_arrays(field_name + postings.FIELD_SEPARATOR + token, reader)
+                if postings_arrays is None:
+                    continue
 
-                norm_query += np.square(wt_query)
+                term_document_ids, term_tfs = postings_arrays
+                positions = np.searchsorted(term_document_ids, document_ids)
+                found = positions < len(term_document_ids)
+                found[found] = term_document_ids[positions[found]] == document_ids[found]
 
-                for document_id, tf in postings_list:
-                    tf = np.log10(tf + 1) # Calculate the tf of the token in the document
-                    wt = tf * idf # Calculate the weight of the token in the document
+                lengths = reader.field_lengths[field_number, document_ids[found]]
+                tfs[found] += self.field_weights.get(field_name, 1.0) * term_tfs[positions[found]] / (1 - BM25_B + BM25_B * lengths / reader.average_field_lengths[field_number])
 
-                    scores[document_id] = scores.get(document_id, 0) + wt_query * wt # Calculate the score of the document
+            df = reader.document_frequency(field + postings.FIELD_SEPARATOR + token if field else token)
+            idf = np.log(1 + (number_of_documents - df + 0.5) / (df + 0.5))
+            scores += idf * tfs / (BM25_K1 + tfs)
 
-        norm_query = np.sqrt(norm_query)
+        if topk < len(scores): # Select the top k without sorting all the documents
+            selected = np.argpartition(-scores, topk - 1)[:topk] if topk > 0 else np.array([], dtype=int)
+            document_ids, scores = document_ids[selected], scores[selected]
+
+        order = np.lexsort((document_ids, -scores)) # By score, ties by docID
 
-        for document_id, score in scores.items():
-            norm_document = self.search_norm(document_id)
+        return [(reader.documents[document_id], float(score)) for document_id, score in zip(document_ids[order], scores[order])]
 
-            if norm_query != 0 and norm_document != 0:
-                scores[document_id] = score / (norm_query * norm_document) # Calculate the cosine similarity
+    def query_key(self, tfs_query, topk, pruning):
+        """Returns the key of a query in the result cache, queries with the same terms share their result."""
+        return (tuple(sorted(tfs_query.items())), topk, pruning)
+
+    @instrumented("index.batch_search")
+    def batch_search(self, queries, topk, workers=4, pruning=False):
+        """
+        queries: a list of the texts of the queries
+        topk: the number of documents to return for each query
+        workers: the number of threads scoring queries (the NumPy scoring releases the GIL)
+        pruning: whether to use dynamic pruning with the per-term max scores
+        """
+        """Returns the top k (track_id, score) pairs of each query in input order, fetching the postings list of every term once for the whole batch."""
+        start_time = time.perf_counter()
+        reader = self.reader() # The same reader for the whole batch
+
+        keys = []
+        tfs_queries = {} # Unique queries: key -> tf of their terms
+        for query in queries:
+            tfs_query = Counter(self.preprocess_query(query))
+            key = self.query_key(tfs_query, topk, pruning)
+            keys.append(key)
+            tfs_queries.setdefault(key, tfs_query)
+        self.instrumentation.count("queries", len(queries))
+
+        results = {}
+        pending = [] # Unique queries not in the result cache
+        for key in tfs_queries:
+            result = self.cache_get(self.result_cache, reader, key)
+            if result is not None:
+                results[key] = result
             else:
-                scores[document_id] = 0
+                pending.append(key)
+
+        terms = {token for key in pending for token in tfs_queries[key]}
+        postings_arrays = {token: self.postings_arrays(token, reader) for token in terms} # Shared by the queries, read only
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for key, result in zip(pending, executor.map(lambda key: self.rank(reader, tfs_queries[key], topk, pruning, postings_arrays), pending)):
+                results[key] = tuple(result)
+                self.cache_put(self.result_cache, reader, key, results[key])
+
+        execution_time = time.perf_counter() - start_time
+        self.batch_stats = {
+            "queries": len(queries),
+            "unique_queries": len(tfs_queries),
+            "cached_queries": len(tfs_queries) - len(pending),
+            "terms": len(terms),
+            "workers": workers,
+            "seconds": round(execution_time, 4),
+            "queries_per_second": round(len(queries) / execution_time, 1) if execution_time else None,
+        }
+
+        return [list(results[key]) for key in keys]
+
+    def rank(self, reader, tfs_query, topk, pruning, postings_arrays):
+        """
+        reader: the reader of the index
+        tfs_query: the tf of each term of the query
+        postings_arrays: the postings arrays (docIDs, tfs) of each term, None if it is not in the index
+        """
+        """Scores the documents for the terms of a query and returns the top k (track_id, score) pairs."""
+        query_terms = [] # (token, docIDs, tfs, weight of the token in the query, idf), the weights in the documents are computed by the scoring
+
+        norm_query = 0
+        for token, tf_query in tfs_query.items():
+            if postings_arrays[token] is None: # If the token is not in the index
+                continue
+
+            document_ids, tfs = postings_arrays[token]
+            idf = reader.idf(token) # The idf of the token (universal for all documents), computed when the index was built
+            wt_query = np.log10(tf_query + 1) * idf # Calculate the weight of the token in the query
+            norm_query += np.square(wt_query)
+
+            query_terms.append((token, document_ids, tfs, wt_query, idf))
+
+        norm_query = np.sqrt(norm_query)
+
+        if pruning and norm_query != 0: # With a zero query norm every candidate scores 0, there is nothing to prune
+            return self.top_k_maxscore(reader, query_terms, norm_query, topk)
+
+        return self.top_k_exhaustive(reader, query_terms, norm_query, topk)
+
+    def top_k_exhaustive(self, reader, query_terms, norm_query, topk):
+        """Scores every posting of the query terms (term-at-a-time) and returns the top k (track_id, score) pairs."""
+        scores = np.zeros(len(reader.documents)) # Score of each docID
+        candidates = np.zeros(len(reader.documents), dtype=bool) # Documents containing at least one term of the query
+
+        postings_evaluated = 0
+        for token, document_ids, tfs, wt_query, idf in query_terms:
+            scores[document_ids] += wt_query * np.log10(tfs + 1) * idf # docIDs are unique in a postings list
+            candidates[document_ids] = True
+            postings_evaluated += len(document_ids)
+
+        return self.top_k_candidates(reader, scores, np.flatnonzero(candidates), norm_query, topk, postings_evaluated)
+
+    def top_k_maxscore(self, reader, query_terms, norm_query, topk):
+        """Scores with MaxScore dynamic pruning: the terms whose upper bounds add up below the top k threshold are only searched for the documents of the other terms (their postings are still decoded, postings_evaluated only counts the ones scored)."""
+        if topk <= 0: # The threshold is the worst of an empty top k
+            self.postings_evaluated = 0
+            return []
+
+        norms = reader.norms
+
+        # Upper bound of the contribution of each term to the cosine
+        # Inflated by a relative 1e-9 so that rounding never prunes a document that would enter the top k
+        bounds = [wt_query * idf * reader.max_score(token) / norm_query * (1 + 1e-9) for token, document_ids, tfs, wt_query, idf in query_terms]
+
+        # Lower bound of the top k threshold: the k-th best contribution of the shortest postings list, the other terms only add to the cosines
+        token, document_ids, tfs, wt_query, idf = min(query_terms, key=lambda query_term: len(query_term[1]))
+        threshold = -np.inf
+        if len(document_ids) >= topk:
+            norms_documents = norms[document_ids]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                contributions = np.where(norms_documents != 0, wt_query * np.log10(tfs + 1) * idf / (norm_query * norms_documents), 0.0)
+            threshold = np.partition(contributions, len(contributions) - topk)[len(contributions) - topk]
+
+        # The terms with the lowest bounds are not essential as long as their bounds add up below the threshold: a document only in them cannot enter the top k
+        essential = [False] * len(query_terms)
+        upper_bound = 0
+        for term_number in sorted(range(len(query_terms)), key=bounds.__getitem__):
+            upper_bound += bounds[term_number]
+            essential[term_number] = upper_bound >= threshold
+
+        candidates = np.zeros(len(reader.documents), dtype=bool) # Documents containing at least one essential term of the query
+        for (token, document_ids, tfs, wt_query, idf), is_essential in zip(query_terms, essential):
+            if is_essential:
+                candidates[document_ids] = True
+        candidate_ids = np.flatnonzero(candidates)
+
+        scores = np.zeros(len(reader.documents)) # Score of each docID
+        postings_evaluated = 0
+        for (token, document_ids, tfs, wt_query, idf), is_essential in zip(query_terms, essential): # In query order, as the exhaustive scoring adds the terms
+            if is_essential:
+                scores[document_ids] += wt_query * np.log10(tfs + 1) * idf
+                postings_evaluated += len(document_ids)
+            elif len(document_ids): # Skip to the postings of the candidates, their weights only are computed
+                positions = np.minimum(document_ids.searchsorted(candidate_ids), len(document_ids) - 1)
+                found = np.flatnonzero(document_ids[positions] == candidate_ids)
+                scores[candidate_ids[found]] += wt_query * np.log10(tfs[positions[found]] + 1) * idf
+                postings_evaluated += len(found)
+
+        return self.top_k_candidates(reader, scores, candidate_ids, norm_query, topk, postings_evaluated)
+
+    def top_k_candidates(self, reader, scores, document_ids, norm_query, topk, postings_evaluated):
+        """
+        scores: the score of each docID
+        document_ids: the docIDs of the candidates, in order
+        postings_evaluated: the number of postings added to the scores
+        """
+        """Computes the cosine similarity of the candidates and returns the top k (track_id, score) pairs."""
+        norms_documents = reader.norms[document_ids]
+
+        self.postings_evaluated = postings_evaluated
+        self.instrumentation.count("postings_evaluated", postings_evaluated)
+        self.instrumentation.count("norm_lookups", len(document_ids))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cosines = np.where((norm_query != 0) & (norms_documents != 0), scores[document_ids] / (norm_query * norms_documents), 0.0) # Calculate the cosine similarity
+
+        if topk < len(cosines): # Select the top k without sorting all the candidates
+            selected = np.argpartition(-cosines, topk - 1)[:topk] if topk > 0 else np.array([], dtype=int)
+            document_ids, cosines = document_ids[selected], cosines[selected]
 
-        topk_documents = sorted(scores, key=scores.get, reverse=True)[:topk] # Get the top k documents
+        order = np.lexsort((document_ids, -cosines)) # By score, ties by docID
 
-        return topk_documents # Return the top k documents for the query
+        return [(reader.documents[document_id], float(cosine)) for document_id, cosine in zip(document_ids[order], cosines[order])] # Return the top k documents for the query
 
 if __name__ == "__main__":
     all_songs = pd.read_csv(DATA_DIR + "spotify_songs.csv")
@@ -0,0 +1,219 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+# Configuration of the default instrumentation, so that production runs can be diagnosed without code edits
+# SPIMI_INSTRUMENTATION: comma-separated sinks, "log", "json:<path>" and/or "memory" (none by default: aggregates only)
+# SPIMI_PROFILE: "1" to capture a cProfile of the outermost phases
+# SPIMI_TRACE_MEMORY: "1" to capture the tracemalloc peak of the outermost phases
+# SPIMI_INSTRUMENTATION_DISABLED: "1" to turn the instrumentation off
+PROFILE_LINES = 20 # Functions of a phase profile reported, by cumulative time
+
+class LogSink:
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger("spimi")
+        self.level = level
+
+    def emit(self, event):
+        self.logger.log(self.level, json.dumps(event))
+
+class JSONSink:
+    def __init__(self, path):
+        """
+        path: the file the events are appended to, one JSON object per line
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self, event):
+        with self.lock, open(self.path, "a") as file:
+            file.write(json.dumps(event) + "\n")
+
+class MemorySink:
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+    def phases(self, name=None):
+        """Returns the phase events, only the ones of a name if given."""
+        return [event for event in self.events if event["type"] == "phase" and (name is None or event["name"] == name)]
+
+class Instrumentation:
+    def __init__(self, sinks=None, profile=False, trace_memory=False, enabled=True):
+        """
+        sinks: the objects whose emit(event) receives every phase and report, none to only aggregate
+        profile: whether to capture a cProfile of the outermost phases (nested ones run inside it)
+        trace_memory: whether to capture the tracemalloc peak of the outermost phases
+        enabled: whether to record anything, a disabled instrumentation costs a function call per phase
+        """
+        self.sinks = list(sinks or [])
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.enabled = enabled
+
+        self.lock = threading.Lock() # Phases and counters are recorded from several threads by the queries
+        self.local = threading.local() # Depth of the running phases of each thread
+        self.profiling = False # A single profiler can be active in the process
+        self.phases = {} # name -> {"count", "total_ns", "max_ns"}
+        self.counters = {} # name -> value
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def emit(self, event):
+        for sink in self.sinks:
+            sink.emit(event)
+
+    def count(self, name, value=1):
+        """Adds a value to a counter."""
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def phase(self, name, **attributes):
+        """
+        name: the name of the phase, its durations are aggregated by name
+        attributes: extra fields of the event of the phase
+        """
+        """Times a block of code with perf_counter_ns, with its profile and memory peak if enabled."""
+        if not self.enabled:
+            yield
+            return
+
+        depth = getattr(self.local, "depth", 0)
+        outermost = depth == 0
+        self.local.depth = depth + 1
+
+        profiler = None
+        if self.profile and outermost:
+            with self.lock:
+                if not self.profiling: # Another thread may be profiling its own phase
+                    self.profiling = True
+                    profiler = cProfile.Profile()
+            if profiler is not None:
+                profiler.enable()
+
+        tracing = self.trace_memory and outermost and not tracemalloc.is_tracing() # Someone else may be tracing already
+        if tracing:
+            tracemalloc.start()
+
+        start_time = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter_ns() - start_time
+            self.local.depth = depth
+
+            event = {"type": "phase", "name": name, "duration_ns": duration, "depth": depth}
+            event.update(attributes)
+
+            if tracing:
+                event["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            if profiler is not None:
+                profiler.disable()
+                self.profiling = False
+                stream = io.StringIO()
+                pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_LINES)
+                event["profile"] = stream.getvalue()
+
+            with self.lock:
+                phase = self.phases.setdefault(name, {"count": 0, "total_ns": 0, "max_ns": 0})
+                phase["count"] += 1
+                phase["total_ns"] += duration
+                phase["max_ns"] = max(phase["max_ns"], duration)
+
+            self.emit(event)
+
+    def timed(self, name=None):
+        """Decorator recording every call of a function as a phase, named after the function by default."""
+        def decorator(function):
+            phase_name = name or function.__qualname__
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.phase(phase_name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def merge(self, report):
+        """Adds the phases and counters of a report, such as the one of a worker process."""
+        with self.lock:
+            for name, other_phase in report["phases"].items():
+                phase = self.phases.setdefault(name, {"count": 0, "total_ns": 0, "max_ns": 0})
+                phase["count"] += other_phase["count"]
+                phase["total_ns"] += other_phase["total_ns"]
+                phase["max_ns"] = max(phase["max_ns"], other_phase["max_ns"])
+
+            for name, value in report["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """Returns the aggregated phases and the counters."""
+        with self.lock:
+            return {"phases": {name: dict(phase) for name, phase in self.phases.items()}, "counters": dict(self.counters)}
+
+    def flush(self):
+        """Emits the aggregated phases and counters to the sinks and returns them."""
+        report = self.report()
+        self.emit(dict(type="report", **report))
+        return report
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}
+            self.counters = {}
+
+def instrumented(name):
+    """Decorator recording the calls of a method as a phase of the instrumentation of its object (self.instrumentation)."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.instrumentation.phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def from_environment(environment=None):
+    """Returns an instrumentation configured by the SPIMI_* environment variables."""
+    environment = os.environ if environment is None else environment
+    sinks = []
+
+    for sink in filter(None, (sink.strip() for sink in environment.get("SPIMI_INSTRUMENTATION", "").split(","))):
+        if sink == "log":
+            sinks.append(LogSink())
+        elif sink == "memory":
+            sinks.append(MemorySink())
+        elif sink.startswith("json:"):
+            sinks.append(JSONSink(sink[len("json:"):]))
+        else:
+            raise ValueError(f"unknown instrumentation sink {sink!r}, expected log, json:<path> or memory")
+
+    return Instrumentation(sinks, profile=environment.get("SPIMI_PROFILE") == "1", trace_memory=environment.get("SPIMI_TRACE_MEMORY") == "1", enabled=environment.get("SPIMI_INSTRUMENTATION_DISABLED") != "1")
+
+default = from_environment() # Used by the components not given an instrumentation of their own
+
+def default_instrumentation():
+    return default
+
+def set_default_instrumentation(instrumentation):
+    """Replaces the default instrumentation, returns the previous one."""
+    global default
+    previous, default = default, instrumentation
+    return previous
@@ -0,0 +1,738 @@
+import ast
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+from array import array
+import numpy as np
+from paths import BLOCKS_DIR
+
+FORMAT_VERSION = 2 # Bump whenever the layout of any of the files below changes
+
+BLOCK_MAGIC = b"SPMB" # Sorted run of (term, postings list) written by SPIMI and the merge
+POSITIONAL_BLOCK_MAGIC = b"SPMQ" # Sorted run of (term, postings list with the positions of every posting)
+LEXICON_MAGIC = b"SPML" # Term dictionary of the global index (global_index.bin)
+POSTINGS_MAGIC = b"SPMP" # Encoded postings lists of the global index (postings.bin)
+OFFSETS_MAGIC = b"SPMO" # Position of every term in the term dictionary (offsets.bin)
+DOCUMENTS_MAGIC = b"SPMD" # Dense docID -> track_id table (documents.bin)
+NORMS_MAGIC = b"SPMN" # Norm of every document, by docID (norms.bin)
+MAX_SCORES_MAGIC = b"SPMS" # Upper bound of the score of every term, in term order (max_scores.bin)
+POSITIONS_MAGIC = b"SPMT" # Encoded positions of the postings of every term, only in positional indexes (positions.bin)
+POSITION_OFFSETS_MAGIC = b"SPMU" # Position of the positions of every term in positions.bin, in term order (position_offsets.bin)
+FIELD_LENGTHS_MAGIC = b"SPMF" # Number of tokens of every field of every document, only in indexes with fields (field_lengths.bin)
+
+HEADER = struct.Struct("<4sH") # magic, version
+LEXICON_ENTRY = struct.Struct("<IdQI") # document frequency, idf, postings offset, postings length
+OFFSET = struct.Struct("<Q") # Offset of a term in the term dictionary
+DOCUMENT_WIDTH = struct.Struct("<H") # Width in bytes of every track_id in the documents table
+NORM = np.dtype("<f8") # Norm of a document: sqrt of the sum of its squared tf-idf weights
+MAX_SCORE = np.dtype("<f8") # Upper bound of a term: max over its postings of log10(tf + 1) / norm of the document
+POSITION_OFFSET = struct.Struct("<QI") # positions offset, positions length
+POSITIONS_SKIP = 32 # Number of postings between two skip pointers of the positions of a term
+FIELD_LENGTH = np.dtype("<u4") # Number of tokens of a field of a document
+FIELD_SEPARATOR = ":" # Indexes with fields also index every token as field:token, tokens are alphabetic so they never contain it
+
+LEXICON_FILE = "global_index.bin"
+POSTINGS_FILE = "postings.bin"
+OFFSETS_FILE = "offsets.bin" # Not metadata.bin, the offsets of the lines of the text index (global_index.txt) next to it
+DOCUMENTS_FILE = "documents.bin"
+NORMS_FILE = "norms.bin"
+MAX_SCORES_FILE = "max_scores.bin"
+POSITIONS_FILE = "positions.bin"
+POSITION_OFFSETS_FILE = "position_offsets.bin"
+FIELD_LENGTHS_FILE = "field_lengths.bin"
+INDEX_FILES = (LEXICON_FILE, POSTINGS_FILE, OFFSETS_FILE, DOCUMENTS_FILE, NORMS_FILE, MAX_SCORES_FILE, POSITIONS_FILE, POSITION_OFFSETS_FILE, FIELD_LENGTHS_FILE)
+
+# Published indexes live in generation directories (index0/, index1/...) of their directory, CURRENT_FILE names the current one
+CURRENT_FILE = "current"
+GENERATION_PREFIX = "index"
+
+def write_header(file, magic):
+    """Writes the versioned header of a file."""
+    file.write(HEADER.pack(magic, FORMAT_VERSION))
+
+def read_header(file, magic):
+    """Reads and validates the versioned header of a file, magic may be a tuple of the accepted ones. Returns the magic of the file."""
+    header = file.read(HEADER.size)
+
+    if len(header) != HEADER.size:
+        raise ValueError(f"{file.name}: missing header")
+
+    file_magic, version = HEADER.unpack(header)
+
+    if file_magic not in (magic if isinstance(magic, tuple) else (magic,)):
+        raise ValueError(f"{file.name}: expected {magic!r} file, found {file_magic!r}")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{file.name}: unsupported format version {version} (expected {FORMAT_VERSION})")
+
+    return file_magic
+
+def encode_vbyte(number, buffer):
+    """Appends the variable-byte encoding of a non-negative integer to the buffer."""
+    while number >= 0x80:
+        buffer.append(number & 0x7F | 0x80) # 7 bits of payload, high bit set means more bytes follow
+        number >>= 7
+    buffer.append(number)
+
+def decode_vbyte(data, position):
+    """Returns the integer encoded at the given position and the position right after it."""
+    number = 0
+    shift = 0
+
+    while True:
+        byte = data[position]
+        position += 1
+        number |= (byte & 0x7F) << shift
+
+        if byte < 0x80:
+            return number, position
+
+        shift += 7
+
+def read_vbyte(file):
+    """Reads a variable-byte encoded integer from a file, returns None at the end of the file."""
+    number = 0
+    shift = 0
+
+    while True:
+        byte = file.read(1)
+
+        if not byte:
+            if shift:
+                raise ValueError(f"{file.name}: truncated variable-byte integer")
+            return None
+
+        byte = byte[0]
+        number |= (byte & 0x7F) << shift
+
+        if byte < 0x80:
+            return number
+
+        shift += 7
+
+def encode_postings(postings_list):
+    """
+    postings_list: a list of (docID, tf) sorted by docID, or (docID, tf, positions) in a positional index
+    """
+    """Encodes a postings list as the number of postings followed by (docID gap, tf) pairs, the positions are encoded apart."""
+    buffer = bytearray()
+    encode_vbyte(len(postings_list), buffer)
+
+    previous_document_id = 0
+    for posting in postings_list:
+        encode_vbyte(posting[0] - previous_document_id, buffer) # Delta-gap of the docID
+        encode_vbyte(posting[1], buffer)
+        previous_document_id = posting[0]
+
+    return bytes(buffer)
+
+def encode_postings_array(postings_array):
+    """
+    postings_array: an array of interleaved docIDs and tfs sorted by docID, as accumulated by SPIMI
+    """
+    """Encodes a postings list stored in an array like encode_postings, without building tuples."""
+    buffer = bytearray()
+    encode_vbyte(len(postings_array) // 2, buffer)
+
+    previous_document_id = 0
+    pairs = iter(postings_array)
+    for document_id, tf in zip(pairs, pairs):
+        encode_vbyte(document_id - previous_document_id, buffer) # Delta-gap of the docID
+        encode_vbyte(tf, buffer)
+        previous_document_id = document_id
+
+    return bytes(buffer)
+
+def decode_postings(data):
+    """Decodes a postings list encoded by encode_postings."""
+    count, position = decode_vbyte(data, 0)
+    postings_list = []
+
+    document_id = 0
+    for _ in range(count):
+        gap, position = decode_vbyte(data, position)
+        tf, position = decode_vbyte(data, position)
+        document_id += gap
+        postings_list.append((document_id, tf))
+
+    return postings_list
+
+def decode_vbyte_array(data):
+    """Decodes consecutive variable-byte integers into a NumPy array, without a Python loop."""
+    data = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80) # Last byte of every integer
+    starts = np.concatenate(([0], ends[:-1] + 1)) # First byte of every integer
+    shifts = 7 * (np.arange(len(data)) - np.repeat(starts, ends - starts + 1)) # Bit offset of every byte within its integer
+
+    return np.add.reduceat((data & 0x7F).astype(np.int64) << shifts, starts) if len(data) else np.zeros(0, dtype=np.int64)
+
+def decode_postings_arrays(data):
+    """Decodes a postings list encoded by encode_postings into NumPy arrays of docIDs and tfs, without a Python loop."""
+    numbers = decode_vbyte_array(data)
+
+    # numbers = count, gap, tf, gap, tf, ...
+    return np.cumsum(numbers[1::2]), numbers[2::2].copy() # Not a view, it would keep the whole of numbers alive (in the postings cache too)
+
+def encode_positions(postings_list):
+    """
+    postings_list: a list of (docID, tf, positions) sorted by docID, the positions of each document sorted
+    """
+    """Encodes the positions of a postings list: a skip pointer every POSITIONS_SKIP postings, then the delta-encoded positions of each posting."""
+    data = bytearray()
+    skips = [] # Offset in data of the positions of every POSITIONS_SKIP-th posting
+
+    for i, posting in enumerate(postings_list):
+        if i % POSITIONS_SKIP == 0:
+            skips.append(len(data))
+
+        previous_position = 0
+        for position in posting[2]:
+            encode_vbyte(position - previous_position, data) # Delta-gap of the position within the document
+            previous_position = position
+
+    buffer = bytearray()
+    encode_vbyte(len(skips), buffer)
+    previous_skip = 0
+    for skip in skips:
+        encode_vbyte(skip - previous_skip, buffer)
+        previous_skip = skip
+
+    return bytes(buffer + data)
+
+def decode_skips(data):
+    """Returns the skip pointers of encoded positions and the offset where the positions start."""
+    count, position = decode_vbyte(data, 0)
+    skips = []
+
+    skip = 0
+    for _ in range(count):
+        gap, position = decode_vbyte(data, position)
+        skip += gap
+        skips.append(skip)
+
+    return skips, position
+
+def decode_positions(data, tfs, posting_numbers=None):
+    """
+    data: positions encoded by encode_positions
+    tfs: the tf of every posting of the term, the number of positions of each one
+    posting_numbers: the sorted indexes of the postings whose positions are decoded, all if None
+    """
+    """Returns the sorted positions of the requested postings, decoding only the skip intervals that hold them."""
+    skips, start = decode_skips(data)
+    tfs = np.asarray(tfs)
+    posting_numbers = range(len(tfs)) if posting_numbers is None else posting_numbers
+
+    positions = []
+    interval = None # Skip interval decoded last and the gaps of its postings
+    for posting_number in posting_numbers:
+        skip_number = posting_number // POSITIONS_SKIP
+
+        if interval is None or interval[0] != skip_number:
+            first = skip_number * POSITIONS_SKIP
+            end = start + skips[skip_number + 1] if skip_number + 1 < len(skips) else len(data)
+            interval = (skip_number, decode_vbyte_array(data[start + skips[skip_number]:end]), np.concatenate(([0], np.cumsum(tfs[first:first + POSITIONS_SKIP]))))
+
+        _, gaps, offsets = interval
+        i = posting_number - skip_number * POSITIONS_SKIP
+        positions.append(np.cumsum(gaps[offsets[i]:offsets[i + 1]]))
+
+    return positions
+
+def write_term(file, term, postings_list, positional=False):
+    """Writes a (term, postings list) record of a block, the postings list being a list of (docID, tf) or an array of interleaved docIDs and tfs, or a list of (docID, tf, positions) if positional."""
+    term_encode = term.encode("utf-8")
+    postings_encode = encode_postings_array(postings_list) if isinstance(postings_list, array) else encode_postings(postings_list)
+
+    buffer = bytearray()
+    encode_vbyte(len(term_encode), buffer)
+    buffer += term_encode
+    encode_vbyte(len(postings_encode), buffer)
+    buffer += postings_encode
+
+    if positional:
+        positions_encode = encode_positions(postings_list)
+        encode_vbyte(len(positions_encode), buffer)
+        buffer += positions_encode
+
+    file.write(buffer)
+
+def read_term(file, positional=False):
+    """Reads the next (term, postings list) record of a block, returns None at the end of the file."""
+    term_length = read_vbyte(file)
+
+    if term_length is None:
+        return None
+
+    term = file.read(term_length).decode("utf-8")
+    postings_list = decode_postings(file.read(read_vbyte(file)))
+
+    if positional: # (docID, tf, positions)
+        tfs = [tf for document_id, tf in postings_list]
+        positions = decode_positions(file.read(read_vbyte(file)), tfs)
+        postings_list = [(document_id, tf, tuple(document_positions.tolist())) for (document_id, tf), document_positions in zip(postings_list, positions)]
+
+    return term, postings_list
+
+def write_block(path, items, positional=False):
+    """
+    path: the path of the block
+    items: an iterable of (term, postings list) sorted by term
+    positional: whether the postings lists hold the positions of each posting
+    """
+    """Writes a sorted block to disk."""
+    with open(path, "wb") as file:
+        write_header(file, POSITIONAL_BLOCK_MAGIC if positional else BLOCK_MAGIC)
+        for term, postings_list in items:
+            write_term(file, term, postings_list, positional)
+
+def read_block(path):
+    """Generates the (term, postings list) records of a block, with the positions of each posting in a positional block."""
+    with open(path, "rb") as file:
+        positional = read_header(file, (BLOCK_MAGIC, POSITIONAL_BLOCK_MAGIC)) == POSITIONAL_BLOCK_MAGIC
+
+        while True:
+            record = read_term(file, positional)
+
+            if record is None:
+                break
+
+            yield record
+
+def write_documents(path, track_ids):
+    """Writes the dense docID -> track_id table, every track_id padded to the same width."""
+    track_ids_encode = [track_id.encode("utf-8") for track_id in track_ids]
+    width = max((len(track_id) for track_id in track_ids_encode), default=0)
+
+    with open(path, "wb") as file:
+        write_header(file, DOCUMENTS_MAGIC)
+        file.write(DOCUMENT_WIDTH.pack(width))
+        for track_id in track_ids_encode:
+            file.write(track_id.ljust(width, b"\0"))
+
+def read_documents(path):
+    """Returns the list of track_ids indexed by docID."""
+    with open(path, "rb") as file:
+        read_header(file, DOCUMENTS_MAGIC)
+        width = DOCUMENT_WIDTH.unpack(file.read(DOCUMENT_WIDTH.size))[0]
+        data = file.read()
+
+    return [data[i:i + width].rstrip(b"\0").decode("utf-8") for i in range(0, len(data), width)] if width else []
+
+def write_norms(path, norms):
+    """Writes the norms of the documents, one fixed-size record per docID."""
+    with open(path, "wb") as file:
+        write_header(file, NORMS_MAGIC)
+        file.write(np.asarray(norms, dtype=NORM).tobytes())
+
+def read_norms(path):
+    """Returns the norms of the documents as a NumPy array indexed by docID."""
+    with open(path, "rb") as file:
+        read_header(file, NORMS_MAGIC)
+        return np.frombuffer(file.read(), dtype=NORM)
+
+def write_max_scores(path, max_scores):
+    """Writes the upper bound of the score of every term, in term order."""
+    with open(path, "wb") as file:
+        write_header(file, MAX_SCORES_MAGIC)
+        file.write(np.asarray(max_scores, dtype=MAX_SCORE).tobytes())
+
+def read_max_scores(path):
+    """Returns the upper bounds of the scores of the terms as a NumPy array, None if the index has none."""
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rb") as file:
+        read_header(file, MAX_SCORES_MAGIC)
+        return np.frombuffer(file.read(), dtype=MAX_SCORE)
+
+def write_field_lengths(path, field_names, field_lengths):
+    """Writes the names of the fields and the number of tokens of every field of every document, field by field."""
+    buffer = bytearray()
+    encode_vbyte(len(field_names), buffer)
+    for field_name in field_names:
+        field_name_encode = field_name.encode("utf-8")
+        encode_vbyte(len(field_name_encode), buffer)
+        buffer += field_name_encode
+
+    with open(path, "wb") as file:
+        write_header(file, FIELD_LENGTHS_MAGIC)
+        file.write(buffer)
+        file.write(np.asarray(field_lengths, dtype=FIELD_LENGTH).tobytes())
+
+def read_field_lengths(path):
+    """Returns the names of the fields and their lengths as a (fields, documents) NumPy array, (None, None) if the index has no fields."""
+    if not os.path.exists(path):
+        return None, None
+
+    with open(path, "rb") as file:
+        read_header(file, FIELD_LENGTHS_MAGIC)
+        field_names = tuple(file.read(read_vbyte(file)).decode("utf-8") for _ in range(read_vbyte(file)))
+        return field_names, np.frombuffer(file.read(), dtype=FIELD_LENGTH).reshape(len(field_names), -1)
+
+class IndexWriter:
+    def __init__(self, directory, number_of_documents, idf_documents=None, positional=False, fields=None):
+        """
+        directory: the directory where the global index is written
+        number_of_documents: the number of docIDs of the index
+        idf_documents: the number of documents of the collection used in the idf, number_of_documents if None
+        positional: whether to write the positions of the postings, (docID, tf, positions), to their own files
+        fields: the names of the fields of an index with fields (whose field:token terms are left out of the norms), None otherwise
+        """
+        self.directory = directory
+        self.idf_documents = idf_documents if idf_documents is not None else number_of_documents
+        self.norms = np.zeros(number_of_documents) # Sum of the squared tf-idf weights of each docID, accumulated term by term
+        self.fields = tuple(fields) if fields is not None else None
+        self.field_lengths = np.zeros((len(self.fields), number_of_documents), dtype=np.int64) if fields is not None else None # Tokens of each field of each docID
+        self.file_lexicon = open(os.path.join(directory, LEXICON_FILE), "wb")
+        self.file_postings = open(os.path.join(directory, POSTINGS_FILE), "wb")
+        self.file_offsets = open(os.path.join(directory, OFFSETS_FILE), "wb")
+
+        write_header(self.file_lexicon, LEXICON_MAGIC)
+        write_header(self.file_postings, POSTINGS_MAGIC)
+        write_header(self.file_offsets, OFFSETS_MAGIC)
+
+        self.positional = positional
+        for file_name in (POSITIONS_FILE, POSITION_OFFSETS_FILE): # A non-positional index must not keep the positions of a previous build
+            if not positional and os.path.exists(os.path.join(directory, file_name)):
+                os.remove(os.path.join(directory, file_name))
+        if fields is None and os.path.exists(os.path.join(directory, FIELD_LENGTHS_FILE)):
+            os.remove(os.path.join(directory, FIELD_LENGTHS_FILE))
+
+        if positional:
+            self.file_positions = open(os.path.join(directory, POSITIONS_FILE), "wb")
+            self.file_position_offsets = open(os.path.join(directory, POSITION_OFFSETS_FILE), "wb")
+            write_header(self.file_positions, POSITIONS_MAGIC)
+            write_header(self.file_position_offsets, POSITION_OFFSETS_MAGIC)
+
+    def add(self, term, postings_list):
+        """Appends a term (in sorted order) and its postings list to the global index, accumulating the norms of its documents."""
+        df = len(postings_list)
+        idf = np.log10(self.idf_documents / df)
+
+        document_ids = np.fromiter((posting[0] for posting in postings_list), dtype=np.int64, count=df)
+        tfs = np.fromiter((posting[1] for posting in postings_list), dtype=np.int64, count=df)
+
+        if self.fields is not None and FIELD_SEPARATOR in term: # The tokens of a field term are already in the norms through the token itself
+            self.field_lengths[self.fields.index(term.partition(FIELD_SEPARATOR)[0]), document_ids] += tfs
+        else:
+            self.norms[document_ids] += (np.log10(tfs + 1) * idf) ** 2 # docIDs are unique in a postings list
+
+        postings_encode = encode_postings(postings_list)
+        postings_offset = self.file_postings.tell()
+        self.file_postings.write(postings_encode)
+
+        self.file_offsets.write(OFFSET.pack(self.file_lexicon.tell())) # Position of the term in the dictionary
+
+        term_encode = term.encode("utf-8")
+        buffer = bytearray()
+        encode_vbyte(len(term_encode), buffer)
+        buffer += term_encode
+        buffer += LEXICON_ENTRY.pack(df, idf, postings_offset, len(postings_encode))
+        self.file_lexicon.write(buffer)
+
+        if self.positional: # Stored apart, the queries without phrases never read them
+            positions_encode = encode_positions(postings_list)
+            self.file_position_offsets.write(POSITION_OFFSET.pack(self.file_positions.tell(), len(positions_encode)))
+            self.file_positions.write(positions_encode)
+
+    def write_max_scores(self):
+        """Writes the upper bound of the score of each term, which depends on the final norms."""
+        with IndexReader(self.directory) as reader:
+            inverse_norms = np.divide(1.0, reader.norms, out=np.zeros_like(reader.norms), where=reader.norms != 0) # Documents with norm 0 always score 0
+            max_scores = np.zeros(reader.number_of_terms)
+
+            for term, (term_number, df, idf, postings_offset, postings_length) in reader.entries():
+                document_ids, tfs = decode_postings_arrays(reader.postings_map[postings_offset:postings_offset + postings_length])
+                max_scores[term_number] = np.max(np.log10(tfs + 1) * inverse_norms[document_ids])
+
+        write_max_scores(os.path.join(self.directory, MAX_SCORES_FILE), max_scores)
+
+    def close(self):
+        """Closes the files of the index and writes the norms and the max scores."""
+        self.file_lexicon.close()
+        self.file_postings.close()
+        self.file_offsets.close()
+        if self.positional:
+            self.file_positions.close()
+            self.file_position_offsets.close()
+
+        write_norms(os.path.join(self.directory, NORMS_FILE), np.sqrt(self.norms))
+        if self.fields is not None:
+            write_field_lengths(os.path.join(self.directory, FIELD_LENGTHS_FILE), self.fields, self.field_lengths)
+        self.write_max_scores()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_lexicon_entry(file_lexicon):
+    """Reads the term dictionary entry at the current position: (term, df, idf, postings offset, postings length)."""
+    term_length = read_vbyte(file_lexicon)
+
+    if term_length is None:
+        return None
+
+    term = file_lexicon.read(term_length).decode("utf-8")
+    df, idf, postings_offset, postings_length = LEXICON_ENTRY.unpack(file_lexicon.read(LEXICON_ENTRY.size))
+
+    return term, df, idf, postings_offset, postings_length
+
+def read_postings(file_postings, postings_offset, postings_length):
+    """Reads and decodes the postings list stored at the given offset of the postings file."""
+    file_postings.seek(postings_offset)
+    return decode_postings(file_postings.read(postings_length))
+
+def index_directory(directory=BLOCKS_DIR):
+    """Returns the directory of the files of the index: its current generation if it was published, the directory itself if it was written in place."""
+    path = os.path.join(directory, CURRENT_FILE)
+
+    if not os.path.exists(path):
+        return directory
+
+    with open(path, "r") as file:
+        return os.path.join(directory, file.read().strip(), "")
+
+def publish_index(staging_directory, directory=BLOCKS_DIR):
+    """
+    staging_directory: the directory of a complete index, moved into directory
+    directory: the directory the index is published in, as its next generation
+    """
+    """Publishes an index atomically: readers open either the previous generation or the new one, never a half-written index. Returns the name of the generation."""
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    generations = sorted((name for name in os.listdir(directory) if re.fullmatch(GENERATION_PREFIX + r"\d+", name)), key=lambda name: int(name[len(GENERATION_PREFIX):]))
+    generation = GENERATION_PREFIX + str(int(generations[-1][len(GENERATION_PREFIX):]) + 1 if generations else 0)
+
+    try:
+        os.replace(os.path.normpath(staging_directory), os.path.join(directory, generation))
+    except OSError: # The staging directory is on another file system
+        shutil.move(os.path.normpath(staging_directory), os.path.join(directory, generation))
+
+    path = os.path.join(directory, CURRENT_FILE)
+    with open(path + ".tmp", "w") as file:
+        file.write(generation)
+    os.replace(path + ".tmp", path) # The switch to the new generation
+
+    # The previous generation is kept for the readers still opening it, the older ones and an index written in place are removed
+    for name in generations[:-1]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True) # A reader may still map its files on some platforms, retried on the next publish
+
+    for file_name in INDEX_FILES:
+        try:
+            os.remove(os.path.join(directory, file_name))
+        except OSError:
+            pass
+
+    return generation
+
+def iter_index(directory=BLOCKS_DIR):
+    """Generates the (term, postings list) pairs of the global index in term order."""
+    directory = index_directory(directory)
+    with open(os.path.join(directory, LEXICON_FILE), "rb") as file_lexicon, open(os.path.join(directory, POSTINGS_FILE), "rb") as file_postings:
+        read_header(file_lexicon, LEXICON_MAGIC)
+        read_header(file_postings, POSTINGS_MAGIC)
+
+        while True:
+            entry = read_lexicon_entry(file_lexicon)
+
+            if entry is None:
+                break
+
+            term, df, idf, postings_offset, postings_length = entry
+            yield term, read_postings(file_postings, postings_offset, postings_length)
+
+class IndexReader:
+    def __init__(self, directory=BLOCKS_DIR, load_dictionary=True):
+        """
+        directory: the directory of the global index
+        load_dictionary: whether to load the term dictionary into memory, otherwise terms are binary searched through the offsets
+        """
+        directory = index_directory(directory) # Resolved once, the files of a generation never change
+        self.directory = directory
+        self.lexicon_map = self.map_file(LEXICON_FILE, LEXICON_MAGIC)
+        self.postings_map = self.map_file(POSTINGS_FILE, POSTINGS_MAGIC)
+        self.offsets_map = self.map_file(OFFSETS_FILE, OFFSETS_MAGIC)
+        self.number_of_terms = (len(self.offsets_map) - HEADER.size) // OFFSET.size
+        self.documents = read_documents(os.path.join(directory, DOCUMENTS_FILE)) # docID -> track_id
+        self.norms = read_norms(os.path.join(directory, NORMS_FILE)) # Norms by docID
+        self.max_scores = read_max_scores(os.path.join(directory, MAX_SCORES_FILE)) # Upper bounds by term number, None if not built
+
+        self.positions_map = None # Positions of the postings, None if the index is not positional
+        self.position_offsets_map = None
+        if os.path.exists(os.path.join(directory, POSITIONS_FILE)):
+            self.positions_map = self.map_file(POSITIONS_FILE, POSITIONS_MAGIC)
+            self.position_offsets_map = self.map_file(POSITION_OFFSETS_FILE, POSITION_OFFSETS_MAGIC)
+
+        self.field_names, self.field_lengths = read_field_lengths(os.path.join(directory, FIELD_LENGTHS_FILE)) # None if the index has no fields
+        self.average_field_lengths = self.field_lengths.mean(axis=1) if self.field_lengths is not None and self.field_lengths.shape[1] else None
+
+        self.dictionary = None # term -> (term number, df, idf, postings offset, postings length)
+        if load_dictionary:
+            self.dictionary = dict(self.entries())
+
+    def map_file(self, file_name, magic):
+        """Validates the header of a file of the index and maps it into memory (read only)."""
+        with open(os.path.join(self.directory, file_name), "rb") as file:
+            read_header(file, magic)
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) # The map stays valid after the file is closed
+
+    def lexicon_entry(self, position):
+        """Returns the term at a position of the term dictionary, its (df, idf, postings offset, postings length) and the position of the next term."""
+        term_length, position = decode_vbyte(self.lexicon_map, position)
+        term = self.lexicon_map[position:position + term_length].decode("utf-8")
+        position += term_length
+
+        return term, LEXICON_ENTRY.unpack_from(self.lexicon_map, position), position + LEXICON_ENTRY.size
+
+    def entries(self):
+        """Generates the (term, (term number, df, idf, postings offset, postings length)) of the term dictionary in term order."""
+        position = HEADER.size
+        term_number = 0
+
+        while position < len(self.lexicon_map):
+            term, entry, position = self.lexicon_entry(position)
+            yield term, (term_number,) + entry
+            term_number += 1
+
+    def lookup(self, term):
+        """Returns the (term number, df, idf, postings offset, postings length) of a term, None if it is not in the index."""
+        if self.dictionary is not None:
+            return self.dictionary.get(term)
+
+        low = 0
+        high = self.number_of_terms - 1
+
+        while low <= high: # Binary search through the offsets of the sorted terms
+            mid = (low + high) // 2
+            position = OFFSET.unpack_from(self.offsets_map, HEADER.size + mid * OFFSET.size)[0]
+            other_term, entry, _ = self.lexicon_entry(position)
+
+            if term < other_term:
+                high = mid - 1
+            elif term > other_term:
+                low = mid + 1
+            else:
+                return (mid,) + entry
+
+        return None
+
+    def document_frequency(self, term):
+        """Returns the number of documents containing a term."""
+        entry = self.lookup(term)
+        return entry[1] if entry else 0
+
+    def idf(self, term):
+        """Returns the idf of a term, computed when the index was built."""
+        entry = self.lookup(term)
+        return entry[2] if entry else None
+
+    def postings_list(self, term):
+        """Returns the postings list (docID, tf) of a term, None if it is not in the index."""
+        entry = self.lookup(term)
+
+        if entry is None:
+            return None
+
+        term_number, df, idf, postings_offset, postings_length = entry
+        return decode_postings(self.postings_map[postings_offset:postings_offset + postings_length])
+
+    def postings_arrays(self, term):
+        """Returns the postings list of a term as NumPy arrays (docIDs, tfs), None if it is not in the index."""
+        entry = self.lookup(term)
+
+        if entry is None:
+            return None
+
+        term_number, df, idf, postings_offset, postings_length = entry
+        return decode_postings_arrays(self.postings_map[postings_offset:postings_offset + postings_length])
+
+    def max_score(self, term):
+        """Returns the upper bound of log10(tf + 1) / norm of a term over its postings, None if it is not in the index."""
+        if self.max_scores is None:
+            raise ValueError(f"{self.directory}: the index has no {MAX_SCORES_FILE}, rebuild it to use dynamic pruning")
+
+        entry = self.lookup(term)
+        return float(self.max_scores[entry[0]]) if entry else None
+
+    def positions(self, term, tfs, posting_numbers):
+        """
+        term: a term of the index
+        tfs: the tf of every posting of the term (see postings_arrays)
+        posting_numbers: the sorted indexes of the postings whose positions are returned
+        """
+        """Returns the sorted positions of some postings of a term, skipping to them through the skip pointers."""
+        if self.positions_map is None:
+            raise ValueError(f"{self.directory}: the index has no {POSITIONS_FILE}, rebuild it with positional=True to use phrase queries")
+
+        term_number = self.lookup(term)[0]
+        positions_offset, positions_length = POSITION_OFFSET.unpack_from(self.position_offsets_map, HEADER.size + term_number * POSITION_OFFSET.size)
+
+        return decode_positions(memoryview(self.positions_map)[positions_offset:positions_offset + positions_length], tfs, posting_numbers) # Not copied: only the intervals needed are read
+
+    def close(self):
+        self.lexicon_map.close()
+        self.postings_map.close()
+        self.offsets_map.close()
+        if self.positions_map is not None:
+            self.positions_map.close()
+            self.position_offsets_map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def convert_text_index(file_name_global_index, file_name_metadata, directory=BLOCKS_DIR):
+    """
+    file_name_global_index: the path of a global_index.txt written by the text format
+    file_name_metadata: the path of the metadata.bin with the "i" offsets of its lines
+    directory: the directory where the binary index is published, as its next generation
+    """
+    """Converts an index in the old str()/literal_eval text format to the binary format, written in a staging directory and then published (see publish_index)."""
+    with open(file_name_metadata, "rb") as file_metadata:
+        metadata = file_metadata.read()
+    physical_positions = [physical_position for physical_position, in struct.iter_unpack("i", metadata)]
+
+    def text_index():
+        with open(file_name_global_index, "r") as file_global_index:
+            for physical_position in physical_positions:
+                file_global_index.seek(physical_position)
+                yield ast.literal_eval(file_global_index.readline())
+
+    # The text format keys postings by track_id, the dense docIDs follow the track_id order
+    track_ids = sorted({track_id for term, postings_list in text_index() for track_id, tf in postings_list})
+    document_ids = {track_id: document_id for document_id, track_id in enumerate(track_ids)}
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    staging_directory = tempfile.mkdtemp(prefix="staging_", dir=directory) # Owned by the conversion, on the file system of the published index
+    try:
+        write_documents(os.path.join(staging_directory, DOCUMENTS_FILE), track_ids)
+
+        with IndexWriter(staging_directory, len(track_ids)) as index_writer:
+            for term, postings_list in text_index():
+                tfs = {}
+                for track_id, tf in postings_list: # A document split across two blocks may appear more than once
+                    document_id = document_ids[track_id]
+                    tfs[document_id] = tfs.get(document_id, 0) + tf
+
+                index_writer.add(term, sorted(tfs.items()))
+    except BaseException:
+        shutil.rmtree(staging_directory, ignore_errors=True) # A half-written index is never published
+        raise
+
+    publish_index(staging_directory, directory) # Readers switch to the converted index
+
+    return len(track_ids) # Return the number of documents converted
+
+if __name__ == "__main__": # Convert the text index of BLOCKS_DIR to the binary format
+    number_of_documents = convert_text_index(BLOCKS_DIR + "global_index.txt", BLOCKS_DIR + "metadata.bin", BLOCKS_DIR)
+    print(f"Converted {number_of_documents} documents")
@@ -2,6 +2,7 @@ import json
 import pandas as pd
 import os
 import re
+from functools import lru_cache
 import nltk
 nltk.download('stopwords')
 nltk.download('punkt')
@@ -9,50 +10,197 @@ from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
 from nltk.stem import PorterStemmer
 from paths import DATA_DIR
+from postings import FIELD_SEPARATOR
+from instrumentation import default_instrumentation
+
+ALPHABETIC = re.compile(r'^[A-Za-z]+$')
+
+# Fast path: approximates word_tokenize + the alphabetic filter with regular expressions over the whole document
+TOKEN_SEPARATORS = re.compile(r"(?:[\s,;:@#$%&!?()\[\]{}<>\"*`\u2026\u2018\u2019\u201c\u201d]|\.(?=[\s.]|$)|(?<=\.)\.|--)+") # Punctuation split off by the Treebank tokenizer
+ALPHABETIC_WORD = re.compile(r"'*([a-z]+?)(?:n't|'s|'m|'d|'re|'ve|'ll)?'*") # Quotes and contractions are split off as non-alphabetic tokens
+SPLIT_WORDS = {"cannot": ("can", "not"), "gimme": ("gim", "me"), "gonna": ("gon", "na"), "gotta": ("got", "ta"), "lemme": ("lem", "me"), "wanna": ("wan", "na")} # Split in two by the Treebank tokenizer
+
+TOKENIZERS = ("nltk", "regex")
+
+TEXT_COLUMNS = ["track_name", "track_artist", "lyrics", "track_album_name", "playlist_name", "playlist_genre"] # Columns combined into the content of a song
+FIELDS = dict(zip(["name", "artist", "lyrics", "album", "playlist", "genre"], TEXT_COLUMNS)) # Name of the field of each column, for field:term queries
 
 class Preprocessor:
-    def __init__(self, file_name_data, stop_words=True):
+    def __init__(self, file_name_data, stop_words=True, rows=None, tokenizer="nltk", stem_cache_size=65536, chunk_size=1000, instrumentation=None, positions=False, fields=False, tokens_counter="tokens"):
         """
         file_name_data: the name of the file containing the data (csv)
         stop_words: a boolean indicating whether to remove stop words
+        rows: an optional (start, stop) range of data rows to preprocess (stop None for the rest of the file), all rows if None
+        tokenizer: "nltk" (word_tokenize) or "regex" (compiled regular expressions, much faster)
+        stem_cache_size: the maximum number of words whose stem is cached (LRU), 0 to disable the cache
+        chunk_size: the number of rows read from the csv at a time
+        instrumentation: the Instrumentation recording the phases and counters, the default one if None
+        positions: whether to generate (id, token, position) with the position of the token in its document, stop words included
+        fields: whether to preprocess the columns one by one, generating every token also qualified by its field (field:token)
+        tokens_counter: the name of the counter of the tokens generated, so that queries do not add to the tokens of the build
         """
+        if tokenizer not in TOKENIZERS:
+            raise ValueError(f"tokenizer must be one of {TOKENIZERS}, not {tokenizer!r}")
+
         self.file_name_data = file_name_data
+        self.rows = rows
+        self.tokenizer = tokenizer
+        self.chunk_size = chunk_size
+        self.positions = positions
+        self.fields = fields
+        self.row = None # Data row of the tokens being generated, where an interrupted build resumes
+        self.next_position = 0 # With positions, the position after the last token (stop words included) of the text preprocessed last
+        self.instrumentation = instrumentation if instrumentation is not None else default_instrumentation()
+        self.tokens_counter = tokens_counter
 
         self.stop_words = set(stopwords.words("english")) if stop_words else None # Set of stop words
         self.word_tokenize = word_tokenize # Function for tokenizing words
         self.ps = PorterStemmer() # Stemmer
+        self.stem = lru_cache(maxsize=stem_cache_size)(self.ps.stem) if stem_cache_size else self.ps.stem # Stems keyed by the lowercase word
 
-    def _preprocess(self, id, content):
-        """Preprocess the text by tokenizing, removing stop words, and stemming."""
+    def _tokenize_nltk(self, content):
+        """Tokenizes with word_tokenize, keeping the lowercase alphabetic tokens."""
         tokens = [word.lower() for word in self.word_tokenize(content)] # Tokenize the content of the song and convert to lowercase
+        return [word for word in tokens if ALPHABETIC.match(word)] # Remove non-alphabetic characters
+
+    def _tokenize_regex(self, content):
+        """Tokenizes the whole document with compiled regular expressions, keeping the lowercase alphabetic tokens."""
+        tokens = []
+        for chunk in TOKEN_SEPARATORS.split(content.lower()):
+            match = ALPHABETIC_WORD.fullmatch(chunk)
+            if match: # Chunks with digits, hyphens or other symbols are not alphabetic tokens
+                word = match.group(1)
+                tokens.extend(SPLIT_WORDS.get(word, (word,)))
+        return tokens
+
+    def _preprocess(self, id, content, start=0):
+        """Preprocess the text by tokenizing, removing stop words, and stemming."""
+        tokens = self._tokenize_regex(content) if self.tokenizer == "regex" else self._tokenize_nltk(content)
+
+        if self.positions: # The removed stop words keep their positions, so that phrases match with the same gaps
+            self.next_position = start + len(tokens) # Where the next text of the document starts, after the stop words at the end of this one too
+            tokens = [(position, word) for position, word in enumerate(tokens, start) if not self.stop_words or word not in self.stop_words]
+            self.instrumentation.count(self.tokens_counter, len(tokens))
+
+            for position, token in tokens:
+                yield (id, self.stem(token), position) # Return a tuple of the id, the token and its position
+            return
 
         if self.stop_words: # Remove stop words
             tokens = [word for word in tokens if word not in self.stop_words]
 
-        tokens = [word for word in tokens if re.match(r'^[A-Za-z]+$', word)] # Remove non-alphabetic characters
+        self.instrumentation.count(self.tokens_counter, len(tokens))
 
         for token in tokens:
-            token = self.ps.stem(token)
+            token = self.stem(token)
             yield (id, token) # Return a tuple of the id and the token
 
+    def read_chunks(self):
+        """Reads the data in chunks of chunk_size rows, only the rows of the shard if rows is given."""
+        columns = ["track_id"] + TEXT_COLUMNS
+
+        if self.rows is None:
+            return pd.read_csv(DATA_DIR + self.file_name_data, usecols=columns, dtype=str, chunksize=self.chunk_size)
+
+        start, stop = self.rows # Skip the data rows before the shard (the header is row 0), read to the end if stop is None
+        return pd.read_csv(DATA_DIR + self.file_name_data, usecols=columns, dtype=str, chunksize=self.chunk_size, skiprows=lambda row: 0 < row <= start, nrows=stop - start if stop is not None else None)
+
+    def number_of_rows(self):
+        """Counts the data rows without loading the file into memory."""
+        return sum(len(chunk) for chunk in pd.read_csv(DATA_DIR + self.file_name_data, usecols=["track_id"], dtype=str, chunksize=self.chunk_size))
+
+    def shard_rows(self, number_of_shards):
+        """
+        number_of_shards: the number of shards wanted, fewer if a document spans the rows of several
+        """
+        """Splits the data rows into contiguous (start, stop) ranges of about the same size, cut only where the track_id changes so that no document (its consecutive rows) spans two shards."""
+        number_of_rows = self.number_of_rows()
+        if number_of_rows == 0:
+            return []
+
+        shard_size = -(-number_of_rows // number_of_shards) # Ceiling division
+        starts = [0] # First row of each shard
+        previous_track_id = None # Of the last row with an id, the rows without one are not indexed
+
+        row = 0
+        for chunk in pd.read_csv(DATA_DIR + self.file_name_data, usecols=["track_id"], dtype=str, chunksize=self.chunk_size):
+            for track_id in chunk["track_id"]:
+                if isinstance(track_id, str):
+                    if row >= starts[-1] + shard_size and track_id != previous_track_id: # Past the size of the shard, at the first row of a document
+                        starts.append(row)
+                    previous_track_id = track_id
+                row += 1
+
+        return list(zip(starts, starts[1:] + [number_of_rows]))
+
+    def documents(self):
+        """Generates the (track_id, content) of each row, the content being its text columns joined by spaces (the tuple of their texts with fields)."""
+        chunks = iter(self.read_chunks())
+        start = self.rows[0] if self.rows is not None else 0 # The index of the chunks counts from the first row read
+
+        while True:
+            with self.instrumentation.phase("preprocessor.read_chunk"):
+                chunk = next(chunks, None)
+
+                if chunk is not None:
+                    chunk = chunk[chunk["track_id"].notna()] # Rows without an id cannot be indexed
+                    if self.fields: # The text of each column, missing values as ""
+                        contents = list(zip(*(chunk[column].fillna("") for column in TEXT_COLUMNS)))
+                    else:
+                        contents = chunk[TEXT_COLUMNS[0]].str.cat([chunk[column] for column in TEXT_COLUMNS[1:]], sep=" ", na_rep="") # Combine all the columns into one string, missing values as ""
+
+            if chunk is None:
+                break
+
+            self.instrumentation.count("documents", len(chunk))
+            for row, track_id, content in zip(chunk.index, chunk["track_id"], contents):
+                self.row = start + row
+                yield track_id, content
+
     def preprocess(self):
         """Preprocess the data"""
-        data = pd.read_csv(DATA_DIR + self.file_name_data)
-
-        for index, row in data.iterrows():
-            track_name = row["track_name"]
-            track_artist = row["track_artist"]
-            lyrics = row["lyrics"]
-            track_album_name = row["track_album_name"]
-            playlist_name = row["playlist_name"]
-            playlist_genre = row["playlist_genre"]
+        if self.fields:
+            yield from self.preprocess_fields()
+            return
 
-            content = track_name + " " + track_artist + " " + lyrics + " " + track_album_name + " " + playlist_name + " " + playlist_genre # Combine all the columns into one string
-            track_id = row["track_id"] # The id of the song
+        if self.positions:
+            yield from self.preprocess_positions()
+            return
 
+        for track_id, content in self.documents():
             for tuple_id_token in self._preprocess(track_id, content):
                 yield tuple_id_token # Return a tuple of the id and the token
 
+    def preprocess_positions(self):
+        """Preprocess the data with the position of every token, continuing the positions of a document across its consecutive rows."""
+        previous_track_id = None
+        position = 0
+
+        for track_id, content in self.documents():
+            if track_id != previous_track_id:
+                position = 0
+            previous_track_id = track_id
+
+            yield from self._preprocess(track_id, content, position)
+            position = self.next_position
+
+    def preprocess_fields(self):
+        """Preprocess the data column by column, generating every token as is and then qualified by its field (with the same position)."""
+        previous_track_id = None
+        position = 0
+
+        for track_id, contents in self.documents():
+            if track_id != previous_track_id:
+                position = 0
+            previous_track_id = track_id
+
+            for field, content in zip(FIELDS, contents):
+                for record in self._preprocess(track_id, content, position):
+                    yield record
+                    yield (track_id, field + FIELD_SEPARATOR + record[1]) + record[2:]
+                if self.positions:
+                    position = self.next_position
+
     def token_stream(self):
         """Generates a stream of tokens"""
         for tuple_id_token in self.preprocess():
@@ -0,0 +1,94 @@
+import re
+import numpy as np
+
+OPERATORS = ("AND", "OR", "NOT") # Uppercase only, the lowercase words are terms (or stop words)
+QUERY_TOKENS = re.compile(r"[()]|[^\s()]+")
+
+class QueryParser:
+    def __init__(self, query, fields):
+        """
+        query: a boolean query of terms and field:term operands, AND, OR, NOT and parentheses, adjacent operands are joined by AND
+        fields: the names of the fields an operand can be restricted to
+        """
+        self.tokens = QUERY_TOKENS.findall(query)
+        self.position = 0
+        self.fields = fields
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        """Returns the tree of the query: ("or", children), ("and", children), ("not", child) or ("term", field or None, text)."""
+        if not self.tokens:
+            raise ValueError("empty query")
+
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError(f"unexpected {self.peek()!r} in the query")
+
+        return node
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek() == "OR":
+            self.next()
+            children.append(self.parse_and())
+
+        return children[0] if len(children) == 1 else ("or", children)
+
+    def parse_and(self):
+        children = [self.parse_not()]
+        while self.peek() not in (None, "OR", ")"):
+            if self.peek() == "AND":
+                self.next()
+            children.append(self.parse_not())
+
+        return children[0] if len(children) == 1 else ("and", children)
+
+    def parse_not(self):
+        if self.peek() == "NOT":
+            self.next()
+            return ("not", self.parse_not())
+
+        return self.parse_operand()
+
+    def parse_operand(self):
+        token = self.next()
+
+        if token is None or token in OPERATORS or token == ")":
+            raise ValueError(f"expected a term or a parenthesis, found {token!r}" if token is not None else "the query ends with an operator")
+
+        if token == "(":
+            node = self.parse_or()
+            if self.next() != ")":
+                raise ValueError("missing closing parenthesis")
+            return node
+
+        field, separator, text = token.partition(":")
+        if separator and field.lower() in self.fields:
+            return ("term", field.lower(), text)
+        if separator and field and text:
+            raise ValueError(f"unknown field {field!r}, expected one of {', '.join(self.fields)}")
+
+        return ("term", None, token)
+
+def parse_query(query, fields):
+    """Returns the tree of a boolean query (see QueryParser)."""
+    return QueryParser(query, fields).parse()
+
+def intersect(document_ids, other_document_ids):
+    """Intersects two sorted arrays of docIDs by searching the elements of the shorter one in the longer one."""
+    if len(document_ids) > len(other_document_ids):
+        document_ids, other_document_ids = other_document_ids, document_ids
+
+    # Binary searches of sorted keys: each one starts from the result of the previous key, as a galloping search, in O(short * log(long))
+    positions = np.searchsorted(other_document_ids, document_ids)
+    found = positions < len(other_document_ids)
+    found[found] = other_document_ids[positions[found]] == document_ids[found]
+
+    return document_ids[found]
@@ -0,0 +1,429 @@
+import contextlib
+import json
+import os
+import shutil
+import threading
+import numpy as np
+from spimi import SPIMI
+from paths import BLOCKS_DIR
+import postings
+
+SEGMENTS_DIR = BLOCKS_DIR + "segments/"
+MANIFEST_FILE = "segments.json" # Live segments of the index and their tombstones
+MANIFEST_VERSION = 1
+
+def read_manifest(directory=SEGMENTS_DIR):
+    """Returns the manifest of a segmented index, an empty one if the index has no segments yet."""
+    path = os.path.join(directory, MANIFEST_FILE)
+
+    if not os.path.exists(path):
+        return {"version": MANIFEST_VERSION, "generation": 0, "next_segment": 0, "segments": []}
+
+    with open(path, "r") as file:
+        manifest = json.load(file)
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"{path}: unsupported manifest version {manifest.get('version')} (expected {MANIFEST_VERSION})")
+
+    return manifest
+
+def write_manifest(directory, manifest):
+    """Writes the manifest of a segmented index atomically, readers see either the old or the new one."""
+    path = os.path.join(directory, MANIFEST_FILE)
+
+    with open(path + ".tmp", "w") as file:
+        json.dump(manifest, file)
+    os.replace(path + ".tmp", path)
+
+def live_postings(directory, live, document_ids):
+    """
+    directory: the directory of a segment
+    live: a boolean array, whether each docID of the segment is not deleted
+    document_ids: the new docID of each docID of the segment
+    """
+    """Generates the (term, postings list) pairs of a segment without its deleted documents and with the new docIDs."""
+    for term, postings_list in postings.iter_index(directory):
+        postings_list = [(int(document_ids[document_id]), tf) for document_id, tf in postings_list if live[document_id]]
+
+        if postings_list: # Terms of deleted documents only are dropped
+            yield term, postings_list
+
+def decode_postings_arrays(reader, postings_offset, postings_length):
+    """Decodes the postings list stored at the given offset of the postings of a segment."""
+    return postings.decode_postings_arrays(reader.postings_map[postings_offset:postings_offset + postings_length])
+
+class SegmentedIndex:
+    def __init__(self, directory=SEGMENTS_DIR, options=None, merge_factor=4, max_deleted_ratio=0.5, background=True):
+        """
+        directory: the directory of the segments and their manifest
+        options: the keyword arguments of the SPIMI building the segments
+        merge_factor: the number of segments of the same size tier merged together
+        max_deleted_ratio: a segment with a larger fraction of deleted documents is rewritten without them
+        background: whether the merges run in a background thread
+        """
+        if merge_factor < 2:
+            raise ValueError("merge_factor must be at least 2")
+
+        self.directory = os.path.join(directory, "")
+        self.options = options or {}
+        self.merge_factor = merge_factor
+        self.max_deleted_ratio = max_deleted_ratio
+        self.background = background
+
+        self.lock = threading.Lock() # Guards the manifest, the segments are immutable
+        self.merge_thread = None
+        self.reserved = set() # Segments being built or merged into, not in the manifest yet
+        self.merging = set() # Segments of the manifest being merged
+        self.segment_documents = {} # Cache of the track_ids of each segment
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        self.manifest = read_manifest(self.directory)
+        self.generation = self.manifest["generation"] # Changes with every update, readers of an older generation are stale
+
+    def segment_directory(self, name):
+        """Returns the directory of a segment."""
+        return self.directory + name + "/"
+
+    def documents(self, name):
+        """Returns the track_id of each docID of a segment."""
+        if name not in self.segment_documents:
+            self.segment_documents[name] = postings.read_documents(os.path.join(postings.index_directory(self.segment_directory(name)), postings.DOCUMENTS_FILE))
+        return self.segment_documents[name]
+
+    def new_segment(self):
+        """Reserves the name of a new segment (with the lock held)."""
+        name = "segment" + str(self.manifest["next_segment"])
+        self.manifest["next_segment"] += 1
+        self.reserved.add(name)
+
+        return name
+
+    def commit(self):
+        """Writes the manifest of a new generation (with the lock held)."""
+        self.manifest["generation"] += 1
+        write_manifest(self.directory, self.manifest)
+        self.generation = self.manifest["generation"]
+
+    def remove_unreferenced(self):
+        """Deletes the segments that are neither live nor reserved (with the lock held), such as merged ones or leftovers of a crash."""
+        live = {segment["name"] for segment in self.manifest["segments"]} | self.reserved
+
+        for name in os.listdir(self.directory):
+            if os.path.isdir(self.directory + name) and name not in live:
+                shutil.rmtree(self.directory + name, ignore_errors=True) # A reader may still map its files on some platforms, retried on the next commit
+                self.segment_documents.pop(name, None)
+
+    def delete_track_ids(self, track_ids):
+        """Adds a tombstone to the live documents with the given track_ids (with the lock held), returns the number of documents deleted."""
+        deleted = 0
+
+        for segment in self.manifest["segments"]:
+            tombstones = set(segment["deleted"])
+            for document_id, track_id in enumerate(self.documents(segment["name"])):
+                if track_id in track_ids and document_id not in tombstones:
+                    segment["deleted"].append(document_id)
+                    deleted += 1
+
+            segment["deleted"].sort()
+
+        return deleted
+
+    def add_documents(self, file_name_data):
+        """
+        file_name_data: the name of the file containing the new documents (csv)
+        """
+        """Inverts the documents into a new segment, replacing the older versions of the documents already indexed, and returns its name."""
+        with self.lock:
+            name = self.new_segment()
+
+        try:
+            spimi = SPIMI(file_name_data, directory=self.segment_directory(name), **self.options)
+            spimi.start() # The segment is a complete index of its own documents
+
+            with self.lock:
+                self.reserved.discard(name)
+
+                if spimi.documents:
+                    self.delete_track_ids(set(spimi.documents)) # Updates: the new version replaces the old ones
+                    self.manifest["segments"].append({"name": name, "documents": len(spimi.documents), "deleted": []})
+                    self.segment_documents[name] = spimi.documents
+                    self.commit()
+
+                self.remove_unreferenced()
+        finally:
+            with self.lock:
+                self.reserved.discard(name)
+
+        self.maybe_merge()
+
+        return name if spimi.documents else None
+
+    def delete_documents(self, track_ids):
+        """Deletes the documents with the given track_ids, returns the number of documents deleted."""
+        with self.lock:
+            deleted = self.delete_track_ids(set(track_ids))
+            if deleted:
+                self.commit()
+
+        self.maybe_merge()
+
+        return deleted
+
+    def merge_policy(self):
+        """Returns the names of the segments to merge next (with the lock held), None if there is nothing to merge."""
+        segments = [segment for segment in self.manifest["segments"] if segment["name"] not in self.merging]
+
+        # A segment with too many tombstones is rewritten on its own
+        for segment in segments:
+            if len(segment["deleted"]) > self.max_deleted_ratio * segment["documents"]:
+                return [segment["name"]]
+
+        # Tiered: merge_factor segments whose live documents are within the same power of merge_factor, the smallest tier first
+        tiers = {}
+        for segment in segments:
+            live_documents = segment["documents"] - len(segment["deleted"])
+            tier = 0
+            while live_documents >= self.merge_factor ** (tier + 1):
+                tier += 1
+            tiers.setdefault(tier, []).append(segment["name"])
+
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= self.merge_factor:
+                return tiers[tier][:self.merge_factor]
+
+        return None
+
+    def merge(self, names):
+        """
+        names: the names of the live segments to merge, in manifest order
+        """
+        """Merges segments into a new one without their deleted documents (with the merge of SPIMI), returns its name."""
+        with self.lock:
+            segments = {segment["name"]: segment for segment in self.manifest["segments"]}
+            tombstones = {name: list(segments[name]["deleted"]) for name in names} # Deletions after this point are carried over on commit
+            self.merging.update(names)
+            name = self.new_segment()
+
+        try:
+            documents = []
+            runs = []
+            document_ids = {} # New docID of each docID of each merged segment
+
+            for merged_name in names:
+                track_ids = self.documents(merged_name)
+                live = np.ones(len(track_ids), dtype=bool)
+                live[tombstones[merged_name]] = False
+
+                document_ids[merged_name] = len(documents) + np.cumsum(live) - 1
+                documents += [track_id for track_id, is_live in zip(track_ids, live) if is_live]
+                runs.append(live_postings(self.segment_directory(merged_name), live, document_ids[merged_name]))
+
+            if documents:
+                spimi = SPIMI(None, directory=self.segment_directory(name), **self.options)
+                os.makedirs(spimi.directory)
+                postings.write_documents(spimi.directory + postings.DOCUMENTS_FILE, documents)
+
+                with postings.IndexWriter(spimi.directory, len(documents)) as index_writer:
+                    for term, postings_list in spimi.merge_records(runs): # The segments are disjoint and in docID order
+                        index_writer.add(term, postings_list)
+
+            with self.lock:
+                deleted = []
+                for merged_name in names: # Tombstones added while merging, translated to the new docIDs
+                    new_tombstones = set(segments[merged_name]["deleted"]) - set(tombstones[merged_name])
+                    deleted += [int(document_ids[merged_name][document_id]) for document_id in new_tombstones]
+
+                position = next(i for i, segment in enumerate(self.manifest["segments"]) if segment["name"] == names[0])
+                self.manifest["segments"] = [segment for segment in self.manifest["segments"] if segment["name"] not in names]
+                if documents:
+                    self.manifest["segments"].insert(position, {"name": name, "documents": len(documents), "deleted": sorted(deleted)})
+                    self.segment_documents[name] = documents
+
+                self.reserved.discard(name)
+                self.commit()
+                self.remove_unreferenced()
+        finally:
+            with self.lock:
+                self.merging.difference_update(names)
+                self.reserved.discard(name)
+
+        return name if documents else None
+
+    def compact(self):
+        """Applies the merge policy until there is nothing left to merge, returns the number of merges."""
+        merges = 0
+
+        while True:
+            with self.lock:
+                names = self.merge_policy()
+                if names is None:
+                    return merges
+
+            self.merge(names)
+            merges += 1
+
+    def maybe_merge(self):
+        """Runs the merge policy after an update, in a background thread unless background is False."""
+        if not self.background:
+            self.compact()
+            return
+
+        with self.lock:
+            if self.merge_thread is not None and self.merge_thread.is_alive():
+                return # The running merges pick up the new segments
+
+            self.merge_thread = threading.Thread(target=self.compact, daemon=True)
+            self.merge_thread.start()
+
+    def wait(self):
+        """Waits for the background merges to finish."""
+        merge_thread = self.merge_thread
+        if merge_thread is not None:
+            merge_thread.join()
+
+    def clear(self):
+        """Deletes every segment of the index."""
+        self.wait()
+
+        with self.lock:
+            self.manifest["segments"] = []
+            self.segment_documents = {}
+            self.commit()
+            self.remove_unreferenced()
+
+    def reader(self):
+        """Returns a reader of the current generation of the segments."""
+        return SegmentedReader(self.directory, self.lock)
+
+class SegmentedReader:
+    def __init__(self, directory=SEGMENTS_DIR, lock=None):
+        """
+        directory: the directory of the segments and their manifest
+        lock: the lock of the manifest, only held while it is read and its segments are opened
+        """
+        """Opens the live segments as one index: global docIDs follow the segments, the idf and the norms are computed over all the live documents."""
+        with lock if lock is not None else contextlib.nullcontext(): # No merge deletes a segment while it is opened, an opened segment stays readable once deleted
+            manifest = read_manifest(directory)
+            self.readers = [postings.IndexReader(os.path.join(directory, segment["name"])) for segment in manifest["segments"]]
+
+        self.directory = directory
+        self.generation = manifest["generation"]
+
+        self.bases = [] # Global docID of the first document of each segment
+        self.lives = [] # Whether each docID of each segment is not deleted, None without tombstones
+        self.documents = [] # Global docID -> track_id
+
+        for reader, segment in zip(self.readers, manifest["segments"]):
+            self.bases.append(len(self.documents))
+            self.documents += reader.documents
+
+            live = None
+            if segment["deleted"]:
+                live = np.ones(len(reader.documents), dtype=bool)
+                live[segment["deleted"]] = False
+            self.lives.append(live)
+
+        self.number_of_documents = len(self.documents) - sum(len(segment["deleted"]) for segment in manifest["segments"])
+
+        # Global document frequencies of the live documents, the idf stored in each segment only covers its own
+        # The df of a segment without tombstones is in its dictionary, the postings of the others are decoded once for the dfs and the norms
+        dfs = {}
+        segments_postings = [] # (term, docIDs, tfs) of each segment with tombstones, None for the others
+        for reader, live in zip(self.readers, self.lives):
+            segment_postings = None
+            if live is not None:
+                segment_postings = []
+                for term, (term_number, df, idf, postings_offset, postings_length) in reader.dictionary.items():
+                    document_ids, tfs = decode_postings_arrays(reader, postings_offset, postings_length)
+                    segment_postings.append((term, document_ids, tfs))
+                    dfs[term] = dfs.get(term, 0) + int(np.count_nonzero(live[document_ids]))
+            else:
+                for term, (term_number, df, idf, postings_offset, postings_length) in reader.dictionary.items():
+                    dfs[term] = dfs.get(term, 0) + df
+            segments_postings.append(segment_postings)
+
+        self.idfs = {term: np.log10(self.number_of_documents / df) for term, df in dfs.items() if df}
+        self.dfs = dfs
+
+        # Norms with the global idf, 0 for the deleted documents
+        norms = np.zeros(len(self.documents))
+        for reader, base, live, segment_postings in zip(self.readers, self.bases, self.lives, segments_postings):
+            if segment_postings is None:
+                segment_postings = ((term,) + decode_postings_arrays(reader, postings_offset, postings_length) for term, (term_number, df, idf, postings_offset, postings_length) in reader.dictionary.items() if term in self.idfs)
+
+            for term, document_ids, tfs in segment_postings:
+                if term in self.idfs:
+                    norms[base + document_ids] += (np.log10(tfs + 1) * self.idfs[term]) ** 2
+            if live is not None:
+                norms[base:base + len(live)][~live] = 0
+
+        self.norms = np.sqrt(norms)
+        self.max_scores = {} # Upper bounds of the terms, computed on first use
+
+    def document_frequency(self, term):
+        """Returns the number of live documents containing a term."""
+        return self.dfs.get(term, 0)
+
+    def idf(self, term):
+        """Returns the idf of a term over the live documents, None if no live document contains it."""
+        return self.idfs.get(term)
+
+    def postings_arrays(self, term):
+        """Returns the postings list of a term over the live segments as NumPy arrays (global docIDs, tfs), None if it is not in the index."""
+        if term not in self.idfs:
+            return None
+
+        all_document_ids = []
+        all_tfs = []
+
+        for reader, base, live in zip(self.readers, self.bases, self.lives):
+            entry = reader.lookup(term)
+            if entry is None:
+                continue
+
+            term_number, df, idf, postings_offset, postings_length = entry
+            document_ids, tfs = decode_postings_arrays(reader, postings_offset, postings_length)
+
+            if live is not None: # Skip the deleted documents
+                mask = live[document_ids]
+                document_ids, tfs = document_ids[mask], tfs[mask]
+
+            all_document_ids.append(base + document_ids) # The segments are in docID order
+            all_tfs.append(tfs)
+
+        return np.concatenate(all_document_ids), np.concatenate(all_tfs)
+
+    def postings_list(self, term):
+        """Returns the postings list (global docID, tf) of a term, None if it is not in the index."""
+        postings_arrays = self.postings_arrays(term)
+
+        if postings_arrays is None:
+            return None
+
+        return [(int(document_id), int(tf)) for document_id, tf in zip(*postings_arrays)]
+
+    def max_score(self, term):
+        """Returns the upper bound of log10(tf + 1) / norm of a term over its live postings, None if it is not in the index."""
+        if term not in self.max_scores:
+            postings_arrays = self.postings_arrays(term)
+
+            if postings_arrays is None:
+                return None
+
+            document_ids, tfs = postings_arrays
+            norms = self.norms[document_ids]
+            self.max_scores[term] = float(np.max(np.log10(tfs + 1) * np.divide(1.0, norms, out=np.zeros_like(norms), where=norms != 0)))
+
+        return self.max_scores[term]
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,226 @@
+import asyncio
+import json
+import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from index_inverted import IndexInverted
+
+STATUS_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 414: "URI Too Long", 500: "Internal Server Error", 503: "Service Unavailable"}
+MAX_BODY_BYTES = 1024 ** 2
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class SearchServer:
+    def __init__(self, index_inverted, host="127.0.0.1", port=8000, workers=4, max_in_flight=64, latency_window=10000):
+        """
+        index_inverted: the IndexInverted whose index is served, its reader stays open while the server runs
+        port: the port to listen on, 0 for any free port (see self.port once started)
+        workers: the number of threads running the queries, the event loop never blocks on the index
+        max_in_flight: the maximum number of queries running or waiting for a thread, more are rejected with 503
+        latency_window: the number of latest requests the latency percentiles are computed over
+        """
+        self.index_inverted = index_inverted
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+
+        self.executor = None
+        self.server = None
+        self.in_flight = 0 # Distinct queries running or waiting for a thread
+        self.pending = {} # (query, topk, pruning) -> future of the running query, shared by identical concurrent requests
+        self.latencies = deque(maxlen=latency_window) # Seconds of the latest search requests
+        self.requests = 0
+        self.coalesced = 0 # Requests answered by the query of another request
+        self.rejected = 0
+
+    async def start(self):
+        """Opens the index reader and starts listening."""
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.index_inverted.reader) # Opened once, before the first request
+
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stops listening and waits for the running queries."""
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def search(self, query, topk, pruning):
+        """Runs a query in the executor, or waits for the identical query already running."""
+        key = (query, topk, pruning)
+
+        if key in self.pending:
+            self.coalesced += 1
+            return await asyncio.shield(self.pending[key]) # A cancelled request does not cancel the query of the others
+
+        if self.in_flight >= self.max_in_flight:
+            self.rejected += 1
+            raise HTTPError(503, "too many queries in flight, retry later")
+
+        self.in_flight += 1
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self.index_inverted.cosine_similarity, query, topk, pruning)
+        self.pending[key] = future
+        future.add_done_callback(lambda future: self.finish(key, future))
+
+        return await asyncio.shield(future)
+
+    def finish(self, key, future):
+        """Forgets a query once it is done, later identical requests run it again."""
+        del self.pending[key]
+        self.in_flight -= 1
+
+    def latency_percentiles(self):
+        """Returns the p50, p95 and p99 latencies of the latest search requests in milliseconds."""
+        if not self.latencies:
+            return {"p50": None, "p95": None, "p99": None}
+
+        p50, p95, p99 = np.percentile(np.array(self.latencies) * 1000, [50, 95, 99])
+        return {"p50": round(p50, 3), "p95": round(p95, 3), "p99": round(p99, 3)}
+
+    def stats(self):
+        """Returns the counters and the latency percentiles of the server."""
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "in_flight": self.in_flight,
+            "latency_ms": self.latency_percentiles(),
+            "cache": self.index_inverted.cache_stats(),
+        }
+
+    async def read_line(self, reader, status, message):
+        """
+        reader: the stream of the connection
+        status: the status answered when the line is over the limit of the stream (64 KiB by default)
+        message: the error message answered then
+        """
+        """Reads a line of the request."""
+        try:
+            return (await reader.readline()).decode("latin-1").strip()
+        except (ValueError, asyncio.LimitOverrunError): # readline raises ValueError past the limit
+            raise HTTPError(status, message)
+
+    async def read_request(self, reader):
+        """Reads an HTTP request, returns its method, path, query parameters and body."""
+        request_line = await self.read_line(reader, 414, "request line too long")
+        if not request_line:
+            return None
+
+        try:
+            method, target, version = request_line.split(" ")
+        except ValueError:
+            raise HTTPError(400, "malformed request line")
+
+        headers = {}
+        while True:
+            line = await self.read_line(reader, 400, "header line too long")
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            content_length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HTTPError(400, "Content-Length must be an integer")
+        if content_length < 0:
+            raise HTTPError(400, "Content-Length must not be negative")
+        if content_length > MAX_BODY_BYTES:
+            raise HTTPError(413, "request body too large")
+        body = await reader.readexactly(content_length) if content_length else b""
+
+        url = urllib.parse.urlsplit(target)
+        parameters = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+
+        return method, url.path, parameters, body
+
+    async def route(self, method, path, parameters, body):
+        """Returns the status and the JSON response of a request."""
+        if path == "/stats":
+            return 200, self.stats()
+
+        if path != "/search":
+            raise HTTPError(404, f"unknown path {path}")
+
+        if method == "POST": # JSON body {"query": ..., "topk": ..., "pruning": ...}
+            try:
+                parameters = json.loads(body or b"{}")
+            except ValueError:
+                raise HTTPError(400, "the body must be a JSON object")
+            if not isinstance(parameters, dict):
+                raise HTTPError(400, "the body must be a JSON object")
+        elif method == "GET": # /search?q=...&k=...&pruning=1
+            parameters = {"query": parameters.get("q"), "topk": parameters.get("k", 10), "pruning": parameters.get("pruning", "0") in ("1", "true")}
+        else:
+            raise HTTPError(405, f"method {method} not allowed")
+
+        query = parameters.get("query")
+        if not isinstance(query, str) or not query.strip():
+            raise HTTPError(400, "missing query")
+
+        if isinstance(parameters.get("topk"), bool): # int() would take a JSON true as 1
+            raise HTTPError(400, "topk must be an integer")
+        try:
+            topk = int(parameters.get("topk", 10))
+        except (TypeError, ValueError):
+            raise HTTPError(400, "topk must be an integer")
+
+        pruning = parameters.get("pruning", False)
+        if isinstance(pruning, str): # As in the query string of GET
+            pruning = pruning in ("1", "true")
+        if not isinstance(pruning, bool):
+            raise HTTPError(400, "pruning must be a boolean")
+
+        start_time = time.perf_counter()
+        results = await self.search(query, topk, pruning)
+        self.latencies.append(time.perf_counter() - start_time)
+
+        return 200, {"query": query, "topk": topk, "results": [{"track_id": track_id, "score": score} for track_id, score in results]}
+
+    async def handle(self, reader, writer):
+        """Answers a request of a connection."""
+        try:
+            try:
+                request = await self.read_request(reader)
+                if request is None:
+                    return
+                self.requests += 1
+                status, response = await self.route(*request)
+            except HTTPError as error:
+                status, response = error.status, {"error": str(error)}
+            except asyncio.IncompleteReadError:
+                return
+            except Exception as error: # The query failed, the server keeps running
+                status, response = 500, {"error": f"{type(error).__name__}: {error}"}
+
+            body = json.dumps(response).encode("utf-8")
+            writer.write(f"HTTP/1.1 {status} {STATUS_REASONS[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+if __name__ == "__main__": # Serve the index built by index_inverted.py on http://127.0.0.1:8000/search?q=...
+    index_inverted = IndexInverted("spotify_songs_en.csv", 100)
+    asyncio.run(SearchServer(index_inverted).serve_forever())
@@ -1,237 +1,493 @@
 import json
 import pandas as pd
-import ast
 import sys
 import os
-import struct
-from preprocessor import Preprocessor
+import heapq
+import shutil
+from array import array
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from preprocessor import Preprocessor, FIELDS
 from paths import DATA_DIR, BLOCKS_DIR
+import postings
+from instrumentation import Instrumentation, default_instrumentation, instrumented
+
+# Estimated memory of the in-memory dictionary of a block (CPython object sizes)
+POSTINGS_TYPECODE = "I" # Postings lists are arrays of interleaved docIDs and tfs, unsigned ints of (at least) 4 bytes
+TERM_BYTES = sys.getsizeof(array(POSTINGS_TYPECODE)) # Postings array of a new term (the term string is measured on its own)
+POSTING_BYTES = 2 * array(POSTINGS_TYPECODE).itemsize # docID and tf, without the over-allocation of the array
+POSITION_BYTES = array(POSTINGS_TYPECODE).itemsize # A position of a positional index, in the positions array of its term
+
+STAGING_DIRECTORY = "staging" # Subdirectory owned by the build, where it writes before publishing, nothing else is deleted
+BUILD_MANIFEST_FILE = "build.json" # Progress of the build in its staging directory, an interrupted build resumes from it
+CHECKPOINT_FILE = "checkpoint.json" # Suffix of the progress of an inversion (of each shard), after the prefix of its blocks
+BUILD_MANIFEST_VERSION = 1
+
+SIZE_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+
+def parse_size(size):
+    """Returns the number of bytes of a size given as an int or a string like "512MB"."""
+    if isinstance(size, int):
+        return size
+
+    size = size.strip().upper()
+    for unit in sorted(SIZE_UNITS, key=len, reverse=True): # Match "MB" before "B"
+        if size.endswith(unit):
+            number = size[:-len(unit)].strip()
+            try:
+                return int(float(number) * SIZE_UNITS[unit])
+            except ValueError:
+                break
+
+    raise ValueError(f"invalid size {size!r}, expected bytes or a number followed by one of {', '.join(SIZE_UNITS)}")
+
+def read_build_manifest(path):
+    """Returns the build manifest (or inversion checkpoint) of a path, None if there is none."""
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "r") as file:
+        return json.load(file)
+
+def write_build_manifest(path, manifest):
+    """Writes a build manifest (or inversion checkpoint) atomically, an interrupted write leaves the previous one."""
+    with open(path + ".tmp", "w") as file:
+        json.dump(manifest, file)
+    os.replace(path + ".tmp", path)
+
+def invert_shard(file_name_data, options, shard_number, rows):
+    """
+    options: the keyword arguments of the SPIMI building the shard
+    shard_number: the number of the shard, used to name its blocks
+    rows: the (start, stop) range of data rows of the shard
+    """
+    """Inverts a shard of the data in a worker process, returns its blocks, their statistics, the track_ids of its local docIDs and its instrumentation report."""
+    spimi = SPIMI(file_name_data, instrumentation=Instrumentation(), **options) # Aggregated here, merged into the instrumentation of the parent
+    block_list = spimi.spimi(rows=rows, block_name="block" + str(shard_number) + "_")
+
+    return block_list, spimi.block_stats, spimi.documents, spimi.instrumentation.report()
 
 class SPIMI:
-    def __init__(self, file_name_data, block_limit=200000, stop_words=True):
+    def __init__(self, file_name_data, block_limit=200000, stop_words=True, fan_in=16, workers=1, memory_limit=None, tokenizer="nltk", chunk_size=1000, number_of_documents=None, directory=BLOCKS_DIR, instrumentation=None, positional=False, staging_directory=None, fields=False):
         """
         file_name_data: the name of the file containing the data (csv)
-        block_limit: the maximum size of a block in bytes
+        directory: the directory where the global index is published
+        staging_directory: the directory in which the blocks and the global index are written (in its staging/ subdirectory, owned by the build) before start publishes them, directory if None
+        block_limit: the maximum size of a block in bytes, as measured by sys.getsizeof of the dictionary
+        memory_limit: if given (bytes or a string like "512MB"), flush a block when the estimated memory of its terms and postings reaches it instead
+        tokenizer: the tokenizer of the Preprocessor, "nltk" or "regex"
+        chunk_size: the number of rows of the csv read at a time
+        number_of_documents: the number of documents used in the idf, the number of documents indexed if None
+        fan_in: the maximum number of blocks merged (and open) at the same time
+        workers: the number of processes inverting shards of the data in parallel (1 for a serial build)
+        instrumentation: the Instrumentation recording the phases and counters, the default one if None
+        positional: whether to also index the positions of the tokens, for phrase and proximity queries
+        fields: whether to also index every token as field:token with the length of every field, for boolean queries
         """
+        if fan_in < 2:
+            raise ValueError("fan_in must be at least 2")
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+
         self.file_name_data = file_name_data
+        self.directory = os.path.join(directory, "") # With a trailing separator, file names are appended to it
+        self.staging_parent = staging_directory or self.directory # Where the shards make the same staging directory
+        self.staging_directory = os.path.join(self.staging_parent, STAGING_DIRECTORY, "")
         self.block_limit = block_limit
+        self.memory_limit = parse_size(memory_limit) if memory_limit is not None else None
+        self.block_stats = [] # Statistics (terms, postings, estimated bytes, bytes on disk) of each block
         self.stop_words = stop_words
-
-    def write_block_to_disk(self, dictionary, block_name, block_number, is_sorted=False):
+        self.tokenizer = tokenizer
+        self.chunk_size = chunk_size
+        self.positional = positional
+        self.fields = fields
+        self.number_of_documents = number_of_documents
+        self.fan_in = fan_in
+        self.workers = workers
+        self.document_offsets = {} # First global docID of the blocks written with shard-local docIDs
+        self.merge_passes = [] # Statistics (runs in/out, bytes read/written) of each merge pass
+        self.documents = [] # track_id of each docID, docIDs are assigned densely in order of appearance
+        self.instrumentation = instrumentation if instrumentation is not None else default_instrumentation()
+
+    def write_block_to_disk(self, dictionary, block_name, block_number, is_sorted=False, positions=None):
         """
         dictionary: the dictionary to be written to disk
         block_name: the name of the block to be written to disk
         block_number: the number of the block to be written to disk
         is_sorted: whether the dictionary is sorted or not
+        positions: the positions array of each term of a positional index, aligned with the tfs of its postings
         """
-        """Saves the block to a text file."""
-        if not os.path.exists(BLOCKS_DIR):
-            os.makedirs(BLOCKS_DIR)
+        """Saves the block to a binary file (see postings.write_block)."""
+        if not os.path.exists(self.staging_directory):
+            os.makedirs(self.staging_directory)
 
-        with open(BLOCKS_DIR + block_name + str(block_number) + '.txt', 'w') as file:
-            if is_sorted:
-                for term, postings_list in dictionary.items():
-                    file.write(str((term, postings_list)) + '\n')
-            else:
-                for term, postings_list in sorted(dictionary.items()):
-                    file.write(str((term, postings_list)) + '\n')
+        items = dictionary.items() if is_sorted else sorted(dictionary.items())
+        if positions is not None:
+            items = ((term, self.positional_postings(postings_array, positions[term])) for term, postings_array in items)
 
-        return block_name + str(block_number) + '.txt' # Return the name of the block created
+        postings.write_block(self.staging_directory + block_name + str(block_number) + '.bin', items, positional=positions is not None)
+        self.instrumentation.count("blocks_flushed")
+        self.instrumentation.count("block_bytes_written", os.path.getsize(self.staging_directory + block_name + str(block_number) + '.bin'))
 
-    def spimi(self):
-        """Applies the Single-pass in-memory indexing algorithm to the preprocessed data."""
-        block_number = 0
-        block_list = []
-        dictionary = {} # (term - postings list)
+        return block_name + str(block_number) + '.bin' # Return the name of the block created
+
+    def positional_postings(self, postings_array, positions_array):
+        """Returns the (docID, tf, positions) of a postings array and the positions array of its term."""
+        postings_list = []
+        start = 0
+
+        for i in range(0, len(postings_array), 2):
+            tf = postings_array[i + 1]
+            postings_list.append((postings_array[i], tf, tuple(positions_array[start:start + tf])))
+            start += tf
+
+        return postings_list
+
+    def block_full(self, dictionary, block_bytes):
+        """Returns whether the block must be flushed to disk."""
+        if self.memory_limit is not None:
+            return sys.getsizeof(dictionary) + block_bytes > self.memory_limit # Hash table plus the estimated memory of the terms and postings
+
+        return sys.getsizeof(dictionary) > self.block_limit
+
+    def block_statistics(self, block, dictionary, block_postings, block_bytes):
+        """Returns the statistics of a block written to disk."""
+        return {"block": block, "terms": len(dictionary), "postings": block_postings, "bytes": sys.getsizeof(dictionary) + block_bytes, "bytes_on_disk": os.path.getsize(self.staging_directory + block)}
+
+    def build_options(self):
+        """Returns what the blocks of a build depend on, an interrupted build only resumes if none of them changed."""
+        stat = os.stat(DATA_DIR + self.file_name_data)
+        return {"file_name_data": self.file_name_data, "data_size": stat.st_size, "data_mtime_ns": stat.st_mtime_ns, "block_limit": self.block_limit, "memory_limit": self.memory_limit, "stop_words": self.stop_words, "tokenizer": self.tokenizer, "positional": self.positional, "fields": self.fields}
+
+    def read_checkpoint(self, path, rows):
+        """Returns the checkpoint of an inversion, a new one if there is none or it was made for other data or options."""
+        checkpoint = read_build_manifest(path)
+        rows = list(rows) if rows is not None else None
 
-        preprocessor = Preprocessor(self.file_name_data, stop_words=self.stop_words) # Preprocess the data
+        if checkpoint is None or checkpoint.get("version") != BUILD_MANIFEST_VERSION or checkpoint["options"] != self.build_options() or checkpoint["rows"] != rows:
+            checkpoint = {"version": BUILD_MANIFEST_VERSION, "options": self.build_options(), "rows": rows, "blocks": [], "block_stats": [], "documents": [], "row": rows[0] if rows is not None else 0, "document_tokens": 0, "done": False}
 
-        for track_id, token in preprocessor.token_stream():
-            if token not in dictionary:
-                dictionary[token] = [(track_id, 1)] # Add the token to the dictionary with the track_id and the frequency
-            else: # token already in dictionary
-                postings_list = dictionary[token]
+        return checkpoint
 
-                if postings_list[-1][0] == track_id:
-                    postings_list[-1] = (track_id, postings_list[-1][1] + 1) # Update the frequency
-                else: # different track_id
-                    postings_list.append((track_id, 1))
+    def checkpoint(self, path, checkpoint, block_list, documents_written, document_row, document_tokens, done=False):
+        """
+        path: the path of the checkpoint of the inversion
+        block_list: the blocks written so far, the last one just written
+        documents_written: the number of documents already recorded by the checkpoint
+        document_row: the data row of the first token of the current document, where the inversion resumes
+        document_tokens: the number of tokens of the current document already in the blocks, skipped when it resumes
+        """
+        """Records the blocks written so far and the track_ids of their new documents. Returns the number of documents recorded."""
+        if len(self.documents) > documents_written: # The documents first seen in the last block
+            documents_file = block_list[-1][:-len(".bin")] + "_documents.bin"
+            postings.write_documents(self.staging_directory + documents_file, self.documents[documents_written:])
+            checkpoint["documents"].append(documents_file)
+
+        checkpoint.update(blocks=block_list, block_stats=self.block_stats, row=document_row, document_tokens=document_tokens, done=done)
+        write_build_manifest(path, checkpoint) # After the block and its documents, which an interrupted write overwrites on resume
 
-                dictionary[token] = postings_list # update postings list
+        return len(self.documents)
 
-            if sys.getsizeof(dictionary) > self.block_limit:
-                block_list.append(self.write_block_to_disk(dictionary, "block", block_number)) # Write the block to disk
+    @instrumented("spimi.invert")
+    def spimi(self, rows=None, block_name="block"):
+        """
+        rows: an optional (start, stop) range of data rows to invert, all rows if None
+        block_name: the prefix of the names of the blocks
+        """
+        """Applies the Single-pass in-memory indexing algorithm to the preprocessed data, resuming after the last block of an interrupted inversion."""
+        if not os.path.exists(self.staging_directory):
+            os.makedirs(self.staging_directory)
+
+        checkpoint_path = self.staging_directory + block_name + CHECKPOINT_FILE
+        checkpoint = self.read_checkpoint(checkpoint_path, rows)
+
+        block_list = checkpoint["blocks"]
+        self.block_stats = checkpoint["block_stats"]
+        self.documents = [track_id for documents_file in checkpoint["documents"] for track_id in postings.read_documents(self.staging_directory + documents_file)]
+
+        if checkpoint["done"]:
+            return block_list
+
+        block_number = len(block_list)
+        dictionary = {} # (term - postings array of interleaved docIDs and tfs)
+        positions = {} if self.positional else None # (term - positions of its postings, tf of them per posting)
+        block_postings = 0 # Number of postings in the dictionary
+        block_bytes = 0 # Estimated memory of the terms and postings of the dictionary
+        documents_written = len(self.documents)
+        document_row = checkpoint["row"] # Data row of the first token of the current document
+        document_tokens = checkpoint["document_tokens"] # Tokens of the current document read so far
+
+        if block_list: # Resume from the start of the document the last block ended in, its first tokens are already in the blocks
+            rows = (document_row, rows[1] if rows is not None else None)
+
+        preprocessor = Preprocessor(self.file_name_data, stop_words=self.stop_words, rows=rows, tokenizer=self.tokenizer, chunk_size=self.chunk_size, instrumentation=self.instrumentation, positions=self.positional, fields=self.fields) # Preprocess the data
+
+        for record in islice(preprocessor.token_stream(), document_tokens, None):
+            track_id, token = record[0], record[1]
+            if not self.documents or self.documents[-1] != track_id: # A new document starts
+                self.documents.append(track_id)
+                document_row = preprocessor.row
+                document_tokens = 0
+            document_tokens += 1
+            document_id = len(self.documents) - 1 # Dense docID of the current document
+
+            postings_array = dictionary.get(token)
+
+            if postings_array is None:
+                dictionary[token] = array(POSTINGS_TYPECODE, (document_id, 1)) # Add the token to the dictionary with the docID and the frequency
+                block_postings += 1
+                block_bytes += sys.getsizeof(token) + TERM_BYTES + POSTING_BYTES
+            elif postings_array[-2] == document_id:
+                postings_array[-1] += 1 # Update the frequency in place
+            else: # different docID
+                postings_array.extend((document_id, 1))
+                block_postings += 1
+                block_bytes += POSTING_BYTES
+
+            if positions is not None: # The positions of a token follow the order of the postings
+                if token not in positions:
+                    positions[token] = array(POSTINGS_TYPECODE)
+                    block_bytes += TERM_BYTES
+                positions[token].append(record[2])
+                block_bytes += POSITION_BYTES
+
+            if self.block_full(dictionary, block_bytes):
+                block_list.append(self.write_block_to_disk(dictionary, block_name, block_number, positions=positions)) # Write the block to disk
+                self.block_stats.append(self.block_statistics(block_list[-1], dictionary, block_postings, block_bytes))
+                documents_written = self.checkpoint(checkpoint_path, checkpoint, block_list, documents_written, document_row, document_tokens)
                 block_number += 1 # Increment block number
                 dictionary = {} # reset dictionary
+                positions = {} if self.positional else None
+                block_postings = 0
+                block_bytes = 0
 
         # Write the last block to disk
         if dictionary:
-            block_list.append(self.write_block_to_disk(dictionary, "block", block_number))
+            block_list.append(self.write_block_to_disk(dictionary, block_name, block_number, positions=positions))
+            self.block_stats.append(self.block_statistics(block_list[-1], dictionary, block_postings, block_bytes))
+        self.checkpoint(checkpoint_path, checkpoint, block_list, documents_written, document_row, document_tokens, done=True)
 
         return block_list # Return the list of blocks created
 
-    def merge_blocks(self, merged_block_number, block_names, other_block_names):
-        """
-        merged_block_number: the number of previously created blocks
-        block_names: a list of the names of the blocks to be merged
-        other_block_names: a list of the names of the other blocks to be merged
-        """
-        """Merges two blocks."""
-        merged_block = {} # Merge the two blocks
-        merged_block_list = [] # List of blocks created
-
-        block = None
-        other_block = None
-
-        # Open the blocks to be merged
-        if block_names and other_block_names: # Both lists are not empty
-            block = open(BLOCKS_DIR + block_names[0], "r")
-            other_block = open(BLOCKS_DIR + other_block_names[0], "r")
-
-        elif block_names: # Only block_names is not empty
-            # Rename all blocks in block_names to "local_index" + str(merged_block_number) + ".txt"
-            for block_name in block_names:
-                os.rename(BLOCKS_DIR + block_name, BLOCKS_DIR + "local_index" + str(merged_block_number) + ".txt")
-                merged_block_list.append("local_index" + str(merged_block_number) + ".txt")
-                merged_block_number += 1
-            return merged_block_number, merged_block_list # Return the list of blocks "created"
-
-        elif other_block_names: # Only other_block_names is not empty
-            # Rename all blocks in other_block_names to "local_index" + str(merged_block_number) + ".txt"
-            for block_name in other_block_names:
-                os.rename(BLOCKS_DIR + block_name, BLOCKS_DIR + "local_index" + str(merged_block_number) + ".txt")
-                merged_block_list.append("local_index" + str(merged_block_number) + ".txt")
-                merged_block_number += 1
-            return merged_block_number, merged_block_list # Return the list of blocks "created"
-
-        else: # Both lists are empty
-            return merged_block_number, merged_block_list
-
-        # Merge the blocks
-        block_line = block.readline()
-        other_block_line = other_block.readline()
-        i, j = 0, 0 # index for block_names and other_block_names
-
-        while True:
-            if sys.getsizeof(merged_block) > self.block_limit:
-                    merged_block_list.append(self.write_block_to_disk(merged_block, "local_index", merged_block_number, is_sorted=True)) # Write the block to disk
-                    merged_block_number += 1
-                    merged_block = {}
-
-            # CASE 1: block_names and other_block_names are not empty
-            if block_line and other_block_line:
-                block_term_tuple = ast.literal_eval(block_line)
-                other_block_term_tuple = ast.literal_eval(other_block_line)
-
-                if block_term_tuple[0] == other_block_term_tuple[0]:
-                    merged_postings_list = block_term_tuple[1] + other_block_term_tuple[1]
-                    merged_block[block_term_tuple[0]] = merged_postings_list
-                    block_line = block.readline()
-                    other_block_line = other_block.readline()
-                elif block_term_tuple[0] < other_block_term_tuple[0]:
-                    merged_block[block_term_tuple[0]] = block_term_tuple[1]
-                    block_line = block.readline()
-                else:
-                    merged_block[other_block_term_tuple[0]] = other_block_term_tuple[1]
-                    other_block_line = other_block.readline()
-                
-                if block_line == "":
-                    block.close()
-                    # Delete the block file that was just read
-                    os.remove(BLOCKS_DIR + block_names[i])
-                    i += 1
-                    if i < len(block_names):
-                        block = open(BLOCKS_DIR + block_names[i], "r")
-                        block_line = block.readline()
-
-                if other_block_line == "":
-                    other_block.close()
-                    # Delete the block file that was just read
-                    os.remove(BLOCKS_DIR + other_block_names[j])
-                    j += 1
-                    if j < len(other_block_names):
-                        other_block = open(BLOCKS_DIR + other_block_names[j], "r")
-                        other_block_line = other_block.readline()
-            
-            # CASE 2: block_line is empty
-            elif other_block_line:
-                other_block_term_tuple = ast.literal_eval(other_block_line)
-                merged_block[other_block_term_tuple[0]] = other_block_term_tuple[1]
-                other_block_line = other_block.readline()
-
-                if other_block_line == "":
-                    other_block.close()
-                    # Delete the block file that was just read
-                    os.remove(BLOCKS_DIR + other_block_names[j])
-                    j += 1
-                    if j < len(other_block_names):
-                        other_block = open(BLOCKS_DIR + other_block_names[j], "r")
-                        other_block_line = other_block.readline()
-
-            # CASE 3: other_block_line is empty
-            elif block_line:
-                block_term_tuple = ast.literal_eval(block_line)
-                merged_block[block_term_tuple[0]] = block_term_tuple[1]
-                block_line = block.readline()
-
-                if block_line == "":
-                    block.close()
-                    # Delete the block file that was just read
-                    os.remove(BLOCKS_DIR + block_names[i])
-                    i += 1
-                    if i < len(block_names):
-                        block = open(BLOCKS_DIR + block_names[i], "r")
-                        block_line = block.readline()
-            else:
-                # CASE 4: block_names and other_block_names are empty
-                break
-        
-        if merged_block:
-            merged_block_list.append(self.write_block_to_disk(merged_block, "local_index", merged_block_number, is_sorted=True)) # Write the block to disk
-            merged_block_number += 1
-        
-        return merged_block_number, merged_block_list # Return the number of blocks created and the list of the blocks created
+    @instrumented("spimi.invert_parallel")
+    def spimi_parallel(self):
+        """Inverts contiguous shards of the data in parallel processes, each into its own sorted blocks."""
+        shards = Preprocessor(self.file_name_data, stop_words=self.stop_words, chunk_size=self.chunk_size).shard_rows(self.workers) # No document spans two shards, its positions continue across its rows
+        if not shards: # Nothing to shard, an empty index
+            return self.spimi()
+
+        options = {"block_limit": self.block_limit, "stop_words": self.stop_words, "memory_limit": self.memory_limit, "tokenizer": self.tokenizer, "chunk_size": self.chunk_size, "directory": self.directory, "staging_directory": self.staging_parent, "positional": self.positional, "fields": self.fields}
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(invert_shard, self.file_name_data, options, shard_number, rows) for shard_number, rows in enumerate(shards)]
+            results = [future.result() for future in futures] # In shard order
+
+        block_list = []
+        self.documents = []
+        self.document_offsets = {}
+        self.block_stats = []
+
+        for shard_block_list, shard_block_stats, shard_documents, shard_report in results:
+            self.instrumentation.merge(shard_report)
+
+            document_offset = len(self.documents) # Global docID of the first document of the shard
+            self.documents += shard_documents
+            for block in shard_block_list:
+                self.document_offsets[block] = document_offset
+
+            block_list += shard_block_list
+            self.block_stats += shard_block_stats
+
+        return block_list # Return the list of blocks created, in docID order
+
+    def merge_postings_lists(self, postings_list, other_postings_list):
+        """
+        postings_list: a postings list of a term
+        other_postings_list: a postings list of the same term with greater or equal docIDs
+        """
+        """Concatenates two postings lists, joining the document split across the two blocks (if any)."""
+        if postings_list and other_postings_list and postings_list[-1][0] == other_postings_list[0][0]:
+            posting, other_posting = postings_list[-1], other_postings_list[0]
+            joined_posting = (posting[0], posting[1] + other_posting[1])
+            if len(posting) == 3: # Positional: the positions of both parts, in order
+                joined_posting += (tuple(sorted(posting[2] + other_posting[2])),)
 
-    def merge(self, spimi_blocks):
+            return postings_list[:-1] + [joined_posting] + other_postings_list[1:]
+
+        return postings_list + other_postings_list
+
+    def read_run(self, run_name):
+        """Generates the (term, postings list) records of a block with global docIDs."""
+        document_offset = self.document_offsets.get(run_name, 0)
+
+        for term, postings_list in postings.read_block(self.staging_directory + run_name):
+            if document_offset:
+                postings_list = [(posting[0] + document_offset,) + posting[1:] for posting in postings_list]
+            yield term, postings_list
+
+    def merge_runs(self, run_names):
+        """
+        run_names: a list of the names of the sorted blocks to be merged, in docID order
+        """
+        """Merges the blocks in a single pass with a heap of block cursors, generating (term, postings list) in term order."""
+        return self.merge_records([self.read_run(run_name) for run_name in run_names])
+
+    def merge_records(self, runs):
+        """
+        runs: a list of iterators of (term, postings list) sorted by term, in docID order
+        """
+        """Merges sorted runs with a heap of cursors, generating (term, postings list) in term order."""
+        heap = [] # (term, run number, postings list), ties on the term pop in run (docID) order
+
+        for run_number, run in enumerate(runs):
+            record = next(run, None)
+            if record is not None:
+                heap.append((record[0], run_number, record[1]))
+        heapq.heapify(heap)
+
+        while heap:
+            term, run_number, postings_list = heapq.heappop(heap)
+            consumed_runs = [run_number]
+
+            while heap and heap[0][0] == term: # The same term in other blocks
+                _, run_number, other_postings_list = heapq.heappop(heap)
+                postings_list = self.merge_postings_lists(postings_list, other_postings_list)
+                consumed_runs.append(run_number)
+
+            for run_number in consumed_runs: # Advance the cursors of the blocks that held the term
+                record = next(runs[run_number], None)
+                if record is not None:
+                    heapq.heappush(heap, (record[0], run_number, record[1]))
+
+            yield term, postings_list
+
+    @instrumented("spimi.merge")
+    def merge(self, spimi_blocks, manifest=None):
         """
         spimi_blocks: a list of the names of the blocks created by the spimi algorithm
+        manifest: the build manifest the progress of the merge is recorded in (and resumed from, see start), None for a merge without checkpoints
         """
-        """Merges all the blocks."""
-        merged_block_number = 0
-        controller = {int(block[5:-4]): [block] for block in spimi_blocks}
+        """Merges all the blocks into the global index, at most fan_in blocks at a time."""
+        if manifest is None:
+            manifest = {"merge": self.merge_state(spimi_blocks)}
+            path = None
+        else:
+            path = self.staging_directory + BUILD_MANIFEST_FILE
+
+        state = manifest["merge"]
+        self.merge_passes = state["merge_passes"] # Statistics of each merge pass
+
+        # Cascade: merge groups of fan_in blocks into local indexes until the rest fit in one merge
+        # The runs before the position are the local indexes of the current pass, the ones after it are still to be merged
+        while len(state["runs"]) > self.fan_in or state["position"]:
+            while state["position"] < len(state["runs"]):
+                runs, position = state["runs"], state["position"]
+                group = runs[position:position + self.fan_in]
+
+                if len(group) == 1: # Nothing to merge, carry the block to the next pass
+                    local_index_filename = group[0]
+                else:
+                    local_index_filename = "local_index" + str(state["merged_block_number"]) + ".bin"
+                    state["merged_block_number"] += 1
+
+                    state["bytes_read"] += sum(os.path.getsize(self.staging_directory + run_name) for run_name in group)
+                    postings.write_block(self.staging_directory + local_index_filename, self.merge_runs(group), positional=self.positional)
+                    state["bytes_written"] += os.path.getsize(self.staging_directory + local_index_filename)
+
+                state["runs"] = runs[:position] + [local_index_filename] + runs[position + len(group):]
+                state["position"] = position + 1
+                self.write_checkpoint(path, manifest)
 
-        # Merge the blocks in pairs
-        while len(controller) > 1:
-            new_controller = {}
-            i = 0
+                if len(group) > 1:
+                    for run_name in group:
+                        os.remove(self.staging_directory + run_name) # Delete the blocks that were just merged, once the manifest no longer needs them
 
-            # Merge blocks in pairs
-            while i < len(controller):
-                merged_block_number, merged_blocks_list = self.merge_blocks(merged_block_number, controller[i], controller[i + 1] if i + 1 < len(controller) else [])
-                new_controller[i // 2] = merged_blocks_list
-                i += 2
+            self.merge_passes.append({"runs_in": state["runs_in"], "runs_out": len(state["runs"]), "bytes_read": state["bytes_read"], "bytes_written": state["bytes_written"]})
+            state.update(self.merge_state(state["runs"], self.merge_passes, state["merged_block_number"]))
+            self.write_checkpoint(path, manifest)
 
-            # Update the controller for the next iteration
-            controller = new_controller
+        # Final pass: merge the remaining blocks directly into the global index, accumulating the idf and the norms of the documents
+        runs = state["runs"]
+        bytes_read = sum(os.path.getsize(self.staging_directory + run_name) for run_name in runs)
 
-        global_index = controller[0]
-        return global_index # Return the global index
+        with postings.IndexWriter(self.staging_directory, len(self.documents), self.number_of_documents, positional=self.positional, fields=list(FIELDS) if self.fields else None) as index_writer:
+            for term, postings_list in self.merge_runs(runs):
+                index_writer.add(term, postings_list) # Write the term and its idf to the dictionary and its postings list to the postings file
 
+        index_files = (postings.LEXICON_FILE, postings.POSTINGS_FILE, postings.OFFSETS_FILE, postings.NORMS_FILE, postings.MAX_SCORES_FILE) + ((postings.POSITIONS_FILE, postings.POSITION_OFFSETS_FILE) if self.positional else ()) + ((postings.FIELD_LENGTHS_FILE,) if self.fields else ())
+        bytes_written = sum(os.path.getsize(self.staging_directory + file_name) for file_name in index_files)
+        self.merge_passes.append({"runs_in": len(runs), "runs_out": 1, "bytes_read": bytes_read, "bytes_written": bytes_written})
+
+        manifest["phase"] = "merged"
+        self.write_checkpoint(path, manifest)
+
+        for run_name in runs:
+            os.remove(self.staging_directory + run_name) # Delete the blocks that were just merged
+
+        self.instrumentation.count("merge_passes", len(self.merge_passes))
+        self.instrumentation.count("merge_bytes_written", sum(merge_pass["bytes_written"] for merge_pass in self.merge_passes))
+
+        return self.merge_passes # Return the statistics of each pass
+
+    def merge_state(self, runs, merge_passes=None, merged_block_number=0):
+        """Returns the progress of a merge at the start of a pass over runs."""
+        return {"runs": runs, "runs_in": len(runs), "position": 0, "bytes_read": 0, "bytes_written": 0, "merged_block_number": merged_block_number, "merge_passes": merge_passes if merge_passes is not None else []}
+
+    def write_checkpoint(self, path, manifest):
+        """Writes the build manifest, if the merge records its progress."""
+        if path is not None:
+            write_build_manifest(path, manifest)
+
+    def read_build(self):
+        """Returns the manifest of the interrupted build in the staging directory, a new one in an empty staging directory if it was made for other data or options."""
+        path = self.staging_directory + BUILD_MANIFEST_FILE
+        options = dict(self.build_options(), fan_in=self.fan_in, workers=self.workers, number_of_documents=self.number_of_documents)
+        manifest = read_build_manifest(path)
+
+        if manifest is None and os.path.isdir(self.staging_directory) and os.listdir(self.staging_directory):
+            raise ValueError(f"{self.staging_directory} is not empty and holds no build manifest ({BUILD_MANIFEST_FILE}), its files were not written by a build: move them or choose another staging_directory")
+
+        if manifest is None or manifest.get("version") != BUILD_MANIFEST_VERSION or manifest["options"] != options:
+            if os.path.exists(self.staging_directory):
+                shutil.rmtree(self.staging_directory) # Blocks of another build
+            os.makedirs(self.staging_directory)
+
+            manifest = {"version": BUILD_MANIFEST_VERSION, "options": options, "phase": "invert"}
+            write_build_manifest(path, manifest)
+
+        return manifest
+
+    def publish(self):
+        """Removes the blocks and checkpoints from the staging directory and publishes the global index in it (see postings.publish_index)."""
+        for file_name in os.listdir(self.staging_directory):
+            if file_name not in postings.INDEX_FILES:
+                os.remove(self.staging_directory + file_name)
+
+        return postings.publish_index(self.staging_directory, self.directory)
+
+    @instrumented("spimi.start")
     def start(self):
-        """Start the SPIMI algorithm and merges the blocks to obtain the global index."""
-        blocks = self.spimi() # Apply the SPIMI algorithm
-        global_index = self.merge(blocks) # Merge the blocks
-        
-        with open(BLOCKS_DIR + "global_index.txt", 'w') as global_index_file, open(BLOCKS_DIR + "metadata.bin", 'wb') as metadata_file:
-            physical_position = 0 # Physical position of the term in the global index
-            for local_index_filename in global_index:
-                with open(BLOCKS_DIR + local_index_filename, 'r') as local_index_file:
-                    for line in local_index_file:
-                        global_index_file.write(line)
-                        metadata_file.write(struct.pack("i", physical_position)) # Write the physical position of the term in the global index
-                        physical_position = global_index_file.tell() # Update the physical position
-
-                os.remove(BLOCKS_DIR + local_index_filename) # Delete the local index file
+        """Start the SPIMI algorithm and merges the blocks to obtain the global index, resuming an interrupted build of the same data and options, then publishes it."""
+        manifest = self.read_build()
+        path = self.staging_directory + BUILD_MANIFEST_FILE
+
+        if manifest["phase"] == "invert":
+            blocks = self.spimi() if self.workers == 1 else self.spimi_parallel() # Apply the SPIMI algorithm, the inversions resume from their checkpoints
+            postings.write_documents(self.staging_directory + postings.DOCUMENTS_FILE, self.documents) # Write the docID -> track_id table
+
+            manifest.update(phase="merge", block_stats=self.block_stats, document_offsets=self.document_offsets, merge=self.merge_state(blocks))
+            write_build_manifest(path, manifest)
+        else: # The blocks were all written
+            self.documents = postings.read_documents(self.staging_directory + postings.DOCUMENTS_FILE)
+            self.block_stats = manifest["block_stats"]
+            self.document_offsets = manifest["document_offsets"]
+
+        if manifest["phase"] == "merge":
+            self.merge(manifest["merge"]["runs"], manifest) # Merge the blocks into the global index
+        else:
+            self.merge_passes = manifest["merge"]["merge_passes"]
+
+        self.publish() # Readers switch to the new index
 
         return True # Return True if the algorithm was successful
 
@@ -243,3 +499,7 @@ if __name__ == "__main__": # Example usage
     filtered_english_songs.to_csv(DATA_DIR + "spotify_songs_en.csv", index=False)
     spimi = SPIMI("spotify_songs_en.csv")
     print(spimi.start())
+    for block in spimi.block_stats:
+        print(block)
+    for merge_pass in spimi.merge_passes:
+        print(merge_pass)